@@ -0,0 +1,51 @@
+"""
+Compares app context overhead for greenlets with context pushed per greenlet
+(app_context) and with reused contexts (AppContextPool): spawn-and-join throughput
+of trivial tasks and bare context wrapper call time.
+Usage: python benchmarks/bench_app_context.py [NUMBER]
+"""
+import sys
+import time
+import timeit
+
+import gevent
+from flask import Flask, g
+
+from flask_vgavro_utils.gevent import app_context, AppContextPool
+
+
+def task():
+    pass
+
+
+def task_with_g():
+    g.value = 1
+
+
+def create_app():
+    app = Flask(__name__)
+    # url adapter is created for app context only with SERVER_NAME
+    app.config['SERVER_NAME'] = 'localhost'
+    for i in range(50):
+        app.add_url_rule('/route{}/<int:id>'.format(i), 'route{}'.format(i), task)
+    return app
+
+
+def bench_spawn(context, func, number):
+    started_at = time.perf_counter()
+    gevent.joinall([gevent.spawn(context(func)) for _ in range(number)])
+    return number / (time.perf_counter() - started_at)
+
+
+def main(number=100000):
+    app = create_app()
+    for name, func in (('trivial', task), ('touching g', task_with_g)):
+        for context_name, context in (('app_context', app_context(app)),
+                                      ('AppContextPool', AppContextPool(app))):
+            call_time = timeit.timeit(context(func), number=number) / number
+            print('{:<12} {:<16} {:>10.0f} spawn+join/s {:>8.2f} us/context'.format(
+                name, context_name, bench_spawn(context, func, number), call_time * 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
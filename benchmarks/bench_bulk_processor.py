@@ -0,0 +1,98 @@
+"""
+Compares gevent CachedBulkProcessor and asyncio AsyncCachedBulkProcessor with
+in-memory caches and worker sleeping 1ms: concurrent lookups of 10% unique ids
+on empty cache (deduplicated workers, single and batch mode) and on warm cache.
+Usage: python benchmarks/bench_bulk_processor.py [LOOKUPS...]
+"""
+import sys
+import time
+import asyncio
+import logging
+
+import gevent
+from gevent.pool import Pool
+
+from flask_vgavro_utils.gevent import CachedBulkProcessor
+from flask_vgavro_utils.asyncio import AsyncCachedBulkProcessor
+
+
+logger = logging.getLogger('bench')
+
+
+class DictCache:
+    def __init__(self):
+        self.data = {}
+
+    def get_many(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def set_many(self, mapping, timeout=None):
+        self.data.update(mapping)
+
+
+class AsyncDictCache(DictCache):
+    async def get_many(self, *keys):
+        return DictCache.get_many(self, *keys)
+
+    async def set_many(self, mapping, timeout=None):
+        DictCache.set_many(self, mapping, timeout)
+
+
+def gevent_worker(entity_id):
+    gevent.sleep(0.001)
+    return {'id': entity_id}
+
+
+def gevent_batch_worker(entity_ids):
+    gevent.sleep(0.001)
+    return {id: {'id': id} for id in entity_ids}
+
+
+async def async_worker(entity_id):
+    await asyncio.sleep(0.001)
+    return {'id': entity_id}
+
+
+async def async_batch_worker(entity_ids):
+    await asyncio.sleep(0.001)
+    return {id: {'id': id} for id in entity_ids}
+
+
+def bench_gevent(lookups, cache, **kwargs):
+    processor = CachedBulkProcessor(Pool(100), cache, 'entity:{}', 60, logger=logger,
+                                    worker=gevent_worker, batch_worker=gevent_batch_worker,
+                                    **kwargs)
+    started_at = time.perf_counter()
+    callers = [gevent.spawn(processor, i % (lookups // 10), join=True) for i in range(lookups)]
+    gevent.joinall(callers)
+    assert all(caller.value for caller in callers)
+    return lookups / (time.perf_counter() - started_at)
+
+
+def bench_asyncio(lookups, cache, **kwargs):
+    async def run():
+        processor = AsyncCachedBulkProcessor(cache, 'entity:{}', 60, concurrency=100,
+                                             logger=logger, worker=async_worker,
+                                             batch_worker=async_batch_worker, **kwargs)
+        started_at = time.perf_counter()
+        rvs = await asyncio.gather(*(processor(i % (lookups // 10), join=True)
+                                     for i in range(lookups)))
+        assert all(rvs)
+        return lookups / (time.perf_counter() - started_at)
+    return asyncio.run(run())
+
+
+def main(*lookups):
+    for lookups_ in lookups or (1000, 10000):
+        for name, bench, cache_class in (('gevent', bench_gevent, DictCache),
+                                         ('asyncio', bench_asyncio, AsyncDictCache)):
+            cache = cache_class()
+            cold = bench(lookups_, cache)
+            warm = bench(lookups_, cache)
+            batch = bench(lookups_, cache_class(), batch_size=100)
+            print('{:>6} lookups {:<8} {:>10.0f} cold/s {:>10.0f} warm/s {:>10.0f} '
+                  'batch cold/s'.format(lookups_, name, cold, warm, batch))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,35 @@
+"""
+Microbenchmarks for cache_function/cache_method key building.
+Usage: python benchmarks/bench_function_hash_key.py [NUMBER]
+"""
+import sys
+import timeit
+
+from flask_vgavro_utils.redis import _create_function_hash_key
+
+
+def positional(user_id, page=1, per_page=20):
+    pass
+
+
+def keywords(user_id, *, page=1, per_page=20, **filters):
+    pass
+
+
+CASES = [
+    ('positional', positional, (123, 2), {}),
+    ('positional+defaults', positional, (123,), {}),
+    ('positional+kwargs', positional, (123,), {'per_page': 50}),
+    ('keyword-only+**kwargs', keywords, (123,), {'page': 2, 'status': 'active'}),
+]
+
+
+def main(number=100000):
+    for name, func, args, kwargs in CASES:
+        hash_key = _create_function_hash_key(func)
+        seconds = timeit.timeit(lambda: hash_key(args, kwargs), number=number)
+        print('{:<25} {:>8.2f} us'.format(name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
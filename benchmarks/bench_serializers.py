@@ -0,0 +1,46 @@
+"""
+Compares cache serializer codecs and compression on representative payloads.
+Usage: python benchmarks/bench_serializers.py [NUMBER]
+"""
+import sys
+import timeit
+
+from flask_vgavro_utils.serializers import Serializer, msgpack, lz4
+
+
+PAYLOADS = {
+    'small': {'id': 123, 'name': 'John Doe', 'active': True, 'score': 4.5},
+    'api_list': {
+        'status': 'OK',
+        'items': [{'id': i, 'name': 'item {}'.format(i), 'tags': ['a', 'b', 'c'],
+                   'price': i * 1.5, 'description': 'lorem ipsum ' * 10}
+                  for i in range(500)],
+    },
+    'wide_ints': list(range(10000)),
+}
+
+SERIALIZERS = [
+    ('pickle', None),
+    ('pickle', 'zlib'),
+    ('json', None),
+    ('json', 'zlib'),
+] + ([('msgpack', None), ('msgpack', 'zlib')] if msgpack else []) + \
+    ([('pickle', 'lz4')] + ([('msgpack', 'lz4')] if msgpack else []) if lz4 else [])
+
+
+def main(number=200):
+    print('{:<10} {:<20} {:>10} {:>12} {:>12}'.format(
+        'payload', 'serializer', 'bytes', 'dumps us', 'loads us'))
+    for name, payload in PAYLOADS.items():
+        for codec, compression in SERIALIZERS:
+            serializer = Serializer(codec, compression)
+            data = serializer.dumps(payload)
+            dumps = timeit.timeit(lambda: serializer.dumps(payload), number=number)
+            loads = timeit.timeit(lambda: serializer.loads(data), number=number)
+            print('{:<10} {:<20} {:>10} {:>12.1f} {:>12.1f}'.format(
+                name, '{}+{}'.format(codec, compression), len(data),
+                dumps / number * 1e6, loads / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
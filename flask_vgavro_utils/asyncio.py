@@ -0,0 +1,252 @@
+import asyncio
+import functools
+import logging
+import time
+
+from redis.asyncio import StrictRedis
+
+from .bulk import BaseCachedBulkProcessor
+from .redis import RateLimitExceeded, RedisRateLimiter
+from .serializers import Serializer
+
+
+logger = logging.getLogger('flask-vgavro-utils.asyncio')
+
+
+class AsyncRedisSerializedCache:
+    """
+    asyncio counterpart of RedisSerializedCache with same keys and serialization,
+    so cached values are shared with gevent services.
+    """
+    def __init__(self, redis_url, base_key=None, serializer=None, **kwargs):
+        self.redis_url = redis_url
+        self.base_key = base_key
+        self.serializer = serializer or Serializer()
+        self._redis = StrictRedis.from_url(redis_url, **kwargs)
+
+    def _build_key(self, key):
+        return self.base_key and '{}:{}'.format(self.base_key, key) or key
+
+    async def get(self, key, default=None):
+        result = await self._redis.get(self._build_key(key))
+        return default if result is None else self.serializer.loads(result)
+
+    async def set(self, key, value, timeout=None):
+        await self._redis.set(self._build_key(key), self.serializer.dumps(value), ex=timeout)
+
+    async def get_many(self, *keys, default=None):
+        if not keys:
+            return []
+        return [default if result is None else self.serializer.loads(result)
+                for result in await self._redis.mget(*map(self._build_key, keys))]
+
+    async def set_many(self, mapping, timeout=None):
+        if not mapping:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                pipe.set(self._build_key(key), self.serializer.dumps(value), ex=timeout)
+            await pipe.execute()
+
+    async def delete(self, *keys):
+        return await self._redis.delete(*map(self._build_key, keys))
+
+
+class AsyncRedisRateLimiter(RedisRateLimiter):
+    """
+    RedisRateLimiter for redis.asyncio client sharing same bucket,
+    acquire is waiting with asyncio.sleep.
+    """
+    def __call__(self, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not await self.acquire():
+                raise RateLimitExceeded(self.name)
+            return await func(*args, **kwargs)
+        return wrapper
+
+    async def try_acquire(self, n=1):
+        assert n <= self.capacity, 'Can\'t acquire more tokens than capacity'
+        return float(await self._acquire_script(keys=[self.name],
+                                                args=[self.rate, self.capacity, n]))
+
+    async def acquire(self, n=1, blocking=True, timeout=None):
+        timeout = timeout or self.timeout
+        deadline = timeout and (time.time() + timeout)
+        while True:
+            wait = await self.try_acquire(n)
+            if not wait:
+                return True
+            if not blocking or (deadline and time.time() + wait > deadline):
+                return False
+            await asyncio.sleep(wait)
+
+
+class AsyncCachedBulkProcessor(BaseCachedBulkProcessor):
+    """
+    asyncio counterpart of gevent CachedBulkProcessor: cache methods, worker and
+    batch_worker are coroutines, and running workers are limited by concurrency
+    instead of gevent pool. rate_limiter should be AsyncRedisRateLimiter.
+    """
+    def __init__(self, cache, cache_key, cache_timeout, concurrency=100, **kwargs):
+        super().__init__(cache, cache_key, cache_timeout, **kwargs)
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    @property
+    def logger(self):
+        return self._logger or logger
+
+    async def __call__(self, *entity_ids, update=True, join=False, timeout=None,
+                       with_timed_out=False):
+        """
+        Same as CachedBulkProcessor.__call__.
+        """
+        entity_ids = set(entity_ids)
+        deadline = timeout and time.monotonic() + timeout
+        rv, workers = {}, []
+        try:
+            await asyncio.wait_for(
+                self._get_or_update(entity_ids, update, rv, workers, pin=not join),
+                min(self.update_timeout, timeout or self.update_timeout))
+        except asyncio.TimeoutError:
+            self.logger.warning('Update timeout: %s', entity_ids)
+            if not with_timed_out:
+                raise
+            return rv, entity_ids.difference(rv)
+
+        timed_out = set()
+        if workers and join:
+            waiting = [id for id in entity_ids.difference(rv) if id in self.workers]
+            join_timeout = (self.join_timeout if deadline is None
+                            else max(0, deadline - time.monotonic()))
+            self._acquire_waiters(waiting)
+            try:
+                # asyncio.wait is not cancelling workers shared between callers
+                _, not_finished = await asyncio.wait(workers, timeout=join_timeout)
+                timed_out = {id for id in waiting if id in self.workers}
+            finally:
+                # Orphaned workers may be cancelled here
+                self._release_waiters(waiting)
+            if not_finished:
+                self.logger.warning('Join timeout: %s, not finished workers: %s',
+                                    join_timeout, len(not_finished))
+            rv_, _ = await self._get_or_update(entity_ids.difference(rv), update=False)
+            rv.update(rv_)
+            timed_out.difference_update(rv)
+        return (rv, timed_out) if with_timed_out else rv
+
+    async def _get_or_update(self, entity_ids, update, rv=None, workers=None, pin=True):
+        rv, workers = {} if rv is None else rv, [] if workers is None else workers
+        entity_ids = tuple(entity_ids)
+        cached = await self.cache.get_many(*(self.cache_key.format(id) for id in entity_ids))
+        rv_, missed, stale = self._split_cached(entity_ids, cached)
+        rv.update(rv_)
+        if update:
+            for entity_id in missed:
+                worker = self.get_or_create_worker(entity_id)
+                if worker is None:
+                    continue  # circuit breaker is open
+                if pin:
+                    self._pinned.add(entity_id)
+                if worker not in workers:
+                    workers.append(worker)
+            for entity_id in stale:
+                # Background refresh, skipped if all workers are busy
+                if entity_id in self.workers or not self._semaphore.locked():
+                    if self.get_or_create_worker(entity_id) is not None:
+                        self._pinned.add(entity_id)
+                        self._refreshing.add(entity_id)
+        return rv, workers
+
+    def _cancel_worker(self, worker):
+        worker.cancel()
+
+    async def _set_cached(self, rv, delta, fail_timeout=None):
+        await asyncio.gather(*(
+            self.cache.set_many(mapping, timeout)
+            for mapping, timeout in self._cache_mappings(rv, delta, fail_timeout)))
+
+    async def _acquire_rate_limiter(self):
+        if self.rate_limiter and not await self.rate_limiter.acquire():
+            raise RateLimitExceeded(self.rate_limiter.name)
+
+    def get_or_create_worker(self, entity_id):
+        if entity_id not in self.workers:
+            ticket = True
+            # Batch worker is checked once on batch creation
+            if not self.batch_size or self._batch is None:
+                ticket = self._allow_worker()
+                if not ticket:
+                    return None
+            if self.batch_size:
+                self._add_to_batch(entity_id)
+            else:
+                self.workers[entity_id] = asyncio.ensure_future(self.worker(entity_id))
+            self._register_probe(ticket, self.workers[entity_id])
+        return self.workers[entity_id]
+
+    def _add_to_batch(self, entity_id):
+        if self._batch is None:
+            entity_ids, full = [], asyncio.Event()
+            task = asyncio.ensure_future(self.batch_worker(entity_ids, full))
+            self._batch = (entity_ids, full, task)
+        entity_ids, full, task = self._batch
+        entity_ids.append(entity_id)
+        self.workers[entity_id] = task
+        if len(entity_ids) >= self.batch_size:
+            full.set()
+            self._batch = None
+
+    async def worker(self, entity_id):
+        self.logger.debug('Starting worker: %s', entity_id)
+        try:
+            async with self._semaphore:
+                started_at = time.time()
+                await self._acquire_rate_limiter()
+                rv = await self._worker(entity_id)
+        except Exception as exc:
+            self.logger.exception('Worker failed: %s %r', entity_id, exc)
+            self._record_worker(exc, asyncio.current_task())
+            await self._set_cached(self._error_rv([entity_id], exc), time.time() - started_at,
+                                   self.cache_error_timeout)
+        except BaseException as exc:
+            self.logger.debug('Worker failed: %s %r', entity_id, exc)
+            raise
+        else:
+            self._record_worker(None, asyncio.current_task())
+            await self._set_cached({entity_id: rv}, time.time() - started_at)
+        finally:
+            self._remove_worker(entity_id, asyncio.current_task())
+
+    async def batch_worker(self, entity_ids, full):
+        try:
+            await asyncio.wait_for(full.wait(), self.batch_wait)
+        except asyncio.TimeoutError:
+            pass
+        if self._batch and self._batch[0] is entity_ids:
+            self._batch = None
+
+        self.logger.debug('Starting batch worker: %s', entity_ids)
+        try:
+            async with self._semaphore:
+                started_at = time.time()
+                await self._acquire_rate_limiter()
+                rv = await self._batch_worker(entity_ids)
+        except Exception as exc:
+            self.logger.exception('Batch worker failed: %s %r', entity_ids, exc)
+            self._record_worker(exc, asyncio.current_task())
+            await self._set_cached(self._error_rv(entity_ids, exc), time.time() - started_at,
+                                   self.cache_error_timeout)
+        except BaseException as exc:
+            self.logger.debug('Batch worker failed: %s %r', entity_ids, exc)
+            raise
+        else:
+            self._record_worker(None, asyncio.current_task())
+            missed = set(entity_ids).difference(rv)
+            if missed:
+                self.logger.warning('Batch worker missed: %s', missed)
+            await self._set_cached(rv, time.time() - started_at)
+        finally:
+            for entity_id in entity_ids:
+                self._remove_worker(entity_id, asyncio.current_task())
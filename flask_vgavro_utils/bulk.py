@@ -0,0 +1,276 @@
+import time
+import math
+import random
+import weakref
+from collections import namedtuple, deque
+
+from flask import current_app
+from werkzeug.utils import cached_property
+
+from .redis import RateLimitExceeded
+
+
+# Cached value with time after which it should be refreshed in background,
+# delta is worker execution time used for probabilistic early refresh
+CacheEntry = namedtuple('CacheEntry', 'value refresh_at delta')
+
+
+class CircuitBreaker:
+    """
+    Opens when failure rate of calls in last window seconds is not less than threshold
+    (and there were at least min_calls), so calls are not allowed for reset_timeout
+    seconds. After that one probe call is allowed (half-open), it's success closes
+    circuit and failure opens it again. allow returns PROBE for probe call and it
+    should be passed to record, results of other calls finished after circuit
+    was opened are ignored.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    PROBE = 'probe'
+
+    def __init__(self, threshold=0.5, min_calls=10, window=60, reset_timeout=30):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.rejected = 0
+        self._calls = deque()  # [(time, failed)]
+        self._failures = 0
+        self._opened_at = self._probe_at = None
+
+    def allow(self):
+        now = time.monotonic()
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        # Probe is allowed again if previous one was not recorded (cancelled)
+        if self.state == self.HALF_OPEN and (
+                self._probe_at is None or now - self._probe_at >= self.reset_timeout):
+            self._probe_at = now
+            return self.PROBE
+        self.rejected += 1
+        return False
+
+    def record(self, failed, ticket=True):
+        """
+        Records call result, ticket is allow() result for this call.
+        """
+        now = time.monotonic()
+        if self.state != self.CLOSED:
+            if self.state == self.HALF_OPEN and ticket == self.PROBE:
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = self.CLOSED
+            return
+        self._calls.append((now, failed))
+        self._failures += failed
+        while self._calls[0][0] < now - self.window:
+            self._failures -= self._calls.popleft()[1]
+        if (len(self._calls) >= self.min_calls and
+           self._failures / len(self._calls) >= self.threshold):
+            self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at, self._probe_at = now, None
+        self._calls.clear()
+        self._failures = 0
+
+    def status(self):
+        return {'state': self.state, 'calls': len(self._calls), 'failures': self._failures,
+                'rejected': self.rejected}
+
+
+class BaseCachedBulkProcessor:
+    """
+    Cache key, timeouts and cached values logic shared by gevent CachedBulkProcessor
+    and asyncio AsyncCachedBulkProcessor, so they are reading and writing same values.
+    """
+    def __init__(self, cache, cache_key, cache_timeout, cache_fail_timeout=None,
+                 update_timeout=10, join_timeout=30, join_timeout_raise=False,
+                 worker=None, batch_worker=None, batch_size=None, batch_wait=0.01,
+                 soft_timeout=None, early_refresh_beta=None, rate_limiter=None,
+                 cancel_orphans=False, cache_error_timeout=None, circuit_breaker=None,
+                 logger=None):
+        self.cache = cache
+        assert '{}' in cache_key, 'Cache key should have format placeholder'
+        self.cache_key = cache_key
+        self.cache_timeout = cache_timeout
+        self.cache_fail_timeout = cache_fail_timeout or cache_timeout
+        self.update_timeout = update_timeout
+        self.join_timeout = join_timeout
+        self.join_timeout_raise = join_timeout_raise
+        if worker:
+            self._worker = worker
+        if batch_worker:
+            self._batch_worker = batch_worker
+        # Batch mode is enabled with batch_size, misses from concurrent calls
+        # are collected for batch_wait seconds (or until batch is full)
+        # and processed with one _batch_worker call
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        # Values older than soft_timeout are returned as is (stale-while-revalidate),
+        # but refreshed in background. With early_refresh_beta refresh may be
+        # started earlier with probability growing to refresh time (XFetch),
+        # values above 1.0 favor earlier refresh.
+        self.soft_timeout = soft_timeout
+        self.early_refresh_beta = early_refresh_beta
+        # Shared between processes upstream limit, acquired on each worker call,
+        # worker fails with RateLimitExceeded if token was not acquired
+        self.rate_limiter = rate_limiter
+        # Cancel worker when all callers joining it are gone (on timeout),
+        # unless it was requested without join or for background refresh
+        self.cancel_orphans = cancel_orphans
+        # Worker exceptions are cached as False (None for callers) for
+        # cache_error_timeout seconds, stale values being refreshed are kept
+        self.cache_error_timeout = cache_error_timeout
+        # Workers are not spawned while circuit breaker is open
+        self.circuit_breaker = circuit_breaker
+        self._logger = logger
+
+        self.workers = {}
+        self._batch = None
+        self._waiters = {}  # {entity_id: count of joining callers}
+        self._pinned = set()  # entity_ids which workers should not be cancelled
+        self._refreshing = set()  # entity_ids with stale values being refreshed
+        self._probes = weakref.WeakSet()  # circuit breaker probe workers
+        self.orphans_cancelled = 0
+
+    @cached_property
+    def logger(self):
+        return self._logger or current_app.logger
+
+    def _split_cached(self, entity_ids, cached):
+        """
+        Returns ({entity_id: value}, missed entity_ids, stale entity_ids)
+        for values from cache.get_many in same order as entity_ids.
+        """
+        rv, missed, stale = {}, [], []
+        for entity_id, data in zip(entity_ids, cached):
+            data, is_stale = self._unpack(data)
+            if data:
+                rv[entity_id] = data
+            elif data is False:
+                rv[entity_id] = None
+            else:
+                missed.append(entity_id)
+                continue
+            if is_stale:
+                stale.append(entity_id)
+        return rv, missed, stale
+
+    def _acquire_waiters(self, entity_ids):
+        for entity_id in entity_ids:
+            self._waiters[entity_id] = self._waiters.get(entity_id, 0) + 1
+
+    def _release_waiters(self, entity_ids):
+        orphans = []
+        for entity_id in entity_ids:
+            self._waiters[entity_id] -= 1
+            if not self._waiters[entity_id]:
+                del self._waiters[entity_id]
+                if entity_id in self.workers and entity_id not in self._pinned:
+                    orphans.append(entity_id)
+        if self.cancel_orphans and orphans:
+            for worker, entity_ids in self._orphaned_workers(orphans).items():
+                self.logger.debug('Cancelling orphaned worker: %s', entity_ids)
+                for entity_id in entity_ids:
+                    del self.workers[entity_id]
+                self.orphans_cancelled += len(entity_ids)
+                self._cancel_worker(worker)
+
+    def _orphaned_workers(self, entity_ids):
+        """
+        Returns {worker: entity_ids} for workers of entity_ids not wanted by anyone,
+        batch worker is cancelled only if all it's entities are not wanted.
+        """
+        rv = {self.workers[entity_id]: [] for entity_id in entity_ids}
+        for entity_id, worker in self.workers.items():
+            if worker in rv:
+                rv[worker].append(entity_id)
+        open_batch = self._batch and self._batch[2]
+        return {
+            worker: entity_ids for worker, entity_ids in rv.items()
+            if worker is not open_batch and not any(
+                id in self._waiters or id in self._pinned for id in entity_ids)
+        }
+
+    def _remove_worker(self, entity_id, worker):
+        # Worker may be already replaced after cancellation
+        if self.workers.get(entity_id) is worker:
+            del self.workers[entity_id]
+            self._pinned.discard(entity_id)
+            self._refreshing.discard(entity_id)
+
+    def _cancel_worker(self, worker):
+        raise NotImplementedError()
+
+    def _allow_worker(self):
+        """
+        Returns circuit breaker ticket, see CircuitBreaker.allow.
+        """
+        return self.circuit_breaker is None or self.circuit_breaker.allow()
+
+    def _register_probe(self, ticket, worker):
+        if ticket == CircuitBreaker.PROBE:
+            self._probes.add(worker)
+
+    def _record_worker(self, exc, worker):
+        """
+        Records worker exception (or None on success) to circuit breaker,
+        exceeded rate limit is not upstream failure and is not recorded.
+        """
+        if self.circuit_breaker is not None and not isinstance(exc, RateLimitExceeded):
+            ticket = CircuitBreaker.PROBE if worker in self._probes else True
+            self._probes.discard(worker)
+            self.circuit_breaker.record(exc is not None, ticket)
+
+    def _error_rv(self, entity_ids, exc):
+        """
+        Returns {entity_id: False} to negative cache on worker exception,
+        exceeded rate limit is not cached.
+        """
+        if not self.cache_error_timeout or isinstance(exc, RateLimitExceeded):
+            return {}
+        return {id: False for id in entity_ids if id not in self._refreshing}
+
+    def _pack(self, value, timeout, now, delta):
+        if not self.soft_timeout and not self.early_refresh_beta:
+            return value
+        refresh_at = now + min(timeout, self.soft_timeout or timeout)
+        return CacheEntry(value, refresh_at, delta)
+
+    def _unpack(self, data):
+        if not isinstance(data, CacheEntry):
+            return data, False
+        refresh_at = data.refresh_at
+        if self.early_refresh_beta and data.delta:
+            refresh_at += data.delta * self.early_refresh_beta * math.log(1 - random.random())
+        return data.value, time.time() >= refresh_at
+
+    def _cache_mappings(self, rv, delta, fail_timeout=None):
+        """
+        Returns [(mapping for cache.set_many, timeout)] for worker result.
+        """
+        now, rv_ = time.time(), []
+        for timeout, entity_ids in (
+            (fail_timeout or self.cache_fail_timeout, [id for id in rv if rv[id] is False]),
+            (self.cache_timeout, [id for id in rv if rv[id] is not False]),
+        ):
+            if entity_ids:
+                rv_.append(({
+                    self.cache_key.format(id): self._pack(rv[id], timeout, now, delta)
+                    for id in entity_ids
+                }, timeout))
+        return rv_
+
+    def _worker(self, entity_id):
+        raise NotImplementedError()
+
+    def _batch_worker(self, entity_ids):
+        """
+        Should return dict {entity_id: result} for up to batch_size entity_ids.
+        """
+        raise NotImplementedError()
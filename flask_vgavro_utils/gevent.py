@@ -1,139 +1,358 @@
+import os
 import sys
+import copy
 import time
+import traceback
+import sysconfig
+import random
+import logging
 from functools import wraps
-from collections import UserDict
+from collections import UserDict, OrderedDict, defaultdict
 from datetime import datetime
 import signal
 
 from flask import current_app
-from werkzeug.utils import cached_property
+from flask.ctx import AppContext
 from greenlet import settrace as greenlet_settrace
 import gevent
 import gevent.monkey
+import gevent.os
+import gevent.socket
 from gevent.hub import get_hub
 from gevent.pool import Pool
 from gevent.greenlet import Greenlet
-from gevent.lock import Semaphore, BoundedSemaphore
-from gevent.pywsgi import WSGIServer
+from gevent.lock import Semaphore
+from gevent.event import Event, AsyncResult
+from gevent.pywsgi import WSGIServer, WSGIHandler
 
 from .app import Flask
+from .bulk import BaseCachedBulkProcessor
+from .metrics import Histogram, format_prometheus
+from .redis import RateLimitExceeded
 from .utils import get_argv_opt, monkey_patch_meth
 
+try:
+    from croniter import croniter
+except ImportError:
+    croniter = None
+
+_missing = object()
+
 
 class LockedFactoryDict(UserDict):
-    def __init__(self, factory=None, timeout=None):
+    """
+    Dict with values created by factory(key) on first access. Concurrent access
+    to key being created waits for same factory result, ready values are read
+    without locking. Values are evicted by max_size (least recently used) and ttl
+    with on_evict(key, value) callback. Factory exceptions are cached for error_timeout
+    seconds (doubled on each consequent failure up to max_error_timeout),
+    so failing factory is not called on every access. Exceptions are stored without
+    traceback, and forgotten after retry (so backoff is reset) or by max_size.
+    """
+    def __init__(self, factory=None, timeout=None, max_size=None, ttl=None,
+                 error_timeout=None, max_error_timeout=60, on_evict=None):
         self._factory = factory
         self.timeout = timeout
+        self.max_size = max_size
+        self.ttl = ttl
+        self.error_timeout = error_timeout
+        self.max_error_timeout = max_error_timeout
+        self.on_evict = on_evict
         super().__init__()
+        self.data = OrderedDict()
+        self._expire_at = {}
+        self._pending = {}  # {key: AsyncResult}
+        self._errors = OrderedDict()  # {key: (exception, retry_at, forget_at, failures)}
+        self.hits = self.misses = self.waits = self.errors = self.evictions = 0
 
     def __getitem__(self, key):
-        if key not in self.data:
+        value = self._get(key)
+        if value is _missing:
+            error = self._get_error(key)
+            if error and error[1] > time.monotonic():
+                self.errors += 1
+                # Copy is raised, so stored exception is not collecting tracebacks
+                raise copy.copy(error[0])
+            self.misses += 1
             self[key] = lambda: self.factory(key)
-        return self.get(key)
-
-    def get(self, key):
-        if key in self.data:
-            if isinstance(self.data[key], BoundedSemaphore):
-                self.data[key].wait(self.timeout)
-                assert not isinstance(self.data[key], BoundedSemaphore)
-            return self.data[key]
+            value = self.data[key]
+        return value
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        return default if value is _missing else value
+
+    def _get_error(self, key):
+        error = self._errors.get(key)
+        if error and error[2] <= time.monotonic():
+            del self._errors[key]
+            return None
+        return error
+
+    def _set_error(self, key, exc):
+        now = time.monotonic()
+        error = self._get_error(key)
+        failures = error and error[3] + 1 or 1
+        timeout = min(self.error_timeout * 2 ** (failures - 1), self.max_error_timeout)
+        self._errors.pop(key, None)
+        # Failure after retry in next timeout is doubling it
+        self._errors[key] = (copy.copy(exc), now + timeout, now + timeout * 2, failures)
+        # Oldest errors are forgotten first
+        while self._errors and (
+                next(iter(self._errors.values()))[2] <= now or
+                self.max_size and len(self._errors) > self.max_size):
+            self._errors.popitem(last=False)
+
+    def _get(self, key):
+        value = self.data.get(key, _missing)
+        if value is not _missing:
+            if self.ttl and self._expire_at[key] < time.monotonic():
+                self._evict(key)
+                return _missing
+            if self.max_size:
+                self.data.move_to_end(key)
+            self.hits += 1
+            return value
+        if key in self._pending:
+            self.waits += 1
+            return self._pending[key].get(timeout=self.timeout)
+        return _missing
 
     def __setitem__(self, key, factory):
         if not callable(factory):
             raise ValueError('value %s should be callable' % factory)
-        lock = self.data[key] = BoundedSemaphore()
-        lock.acquire()
-        self.data[key] = factory()
-        assert not isinstance(self.data[key], BoundedSemaphore)
-        lock.release()
+        pending = self._pending[key] = AsyncResult()
+        try:
+            value = factory()
+        except Exception as exc:
+            pending.set_exception(exc)
+            if self.error_timeout:
+                self._set_error(key, exc)
+            raise
+        else:
+            self._errors.pop(key, None)
+            if key in self.data:
+                self._evict(key)
+            self.data[key] = value
+            if self.ttl:
+                self._expire_at[key] = time.monotonic() + self.ttl
+            pending.set(value)
+            while self.max_size and len(self.data) > self.max_size:
+                self._evict(next(iter(self.data)))
+        finally:
+            del self._pending[key]
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self._expire_at.pop(key, None)
+
+    def _evict(self, key):
+        value = self.data.pop(key)
+        self._expire_at.pop(key, None)
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(key, value)
 
     def factory(self, key):
         if self._factory is not None:
             return self._factory(key)
         raise NotImplementedError()
 
+    def stats(self):
+        return {
+            'size': len(self.data), 'pending': len(self._pending), 'hits': self.hits,
+            'misses': self.misses, 'waits': self.waits, 'errors': self.errors,
+            'evictions': self.evictions,
+        }
 
-class CachedBulkProcessor:
-    def __init__(self, pool, cache, cache_key, cache_timeout, cache_fail_timeout=None,
-                 update_timeout=10, join_timeout=30, join_timeout_raise=False,
-                 worker=None, logger=None):
+
+class CachedBulkProcessor(BaseCachedBulkProcessor):
+    def __init__(self, pool, cache, cache_key, cache_timeout, **kwargs):
         self.pool = pool
-        self.cache = cache
-        assert '{}' in cache_key, 'Cache key should have format placeholder'
-        self.cache_key = cache_key
-        self.cache_timeout = cache_timeout
-        self.cache_fail_timeout = cache_fail_timeout or cache_timeout
-        self.update_timeout = update_timeout
-        self.join_timeout = join_timeout
-        self.join_timeout_raise = join_timeout_raise
-        if worker:
-            self._worker = worker
-        self._logger = logger
-
-        self.workers = {}
-
-    @cached_property
-    def logger(self):
-        return self._logger or current_app.logger
-
-    def __call__(self, *entity_ids, update=True, join=False):
+        super().__init__(cache, cache_key, cache_timeout, **kwargs)
+
+    def __call__(self, *entity_ids, update=True, join=False, timeout=None,
+                 with_timed_out=False):
+        """
+        Returns {entity_id: value} for cached entities, missed are updated in background
+        or waited for with join. timeout limits whole call, otherwise lookup is limited
+        by update_timeout and join by join_timeout. With with_timed_out returns
+        (rv, timed_out entity_ids) instead of raising on lookup timeout.
+        """
         entity_ids = set(entity_ids)
-        # TODO: actualy this timeout is only related to pool waiting,
-        # so maybe move it to self.pool.spawn?
-        timeout = gevent.Timeout.start_new(self.update_timeout)
+        deadline = timeout and time.monotonic() + timeout
+        rv, workers = {}, []
+        timer = gevent.Timeout.start_new(min(self.update_timeout, timeout or self.update_timeout))
         try:
-            rv, workers = self._get_or_update(entity_ids, update)
-        except gevent.Timeout:
+            self._get_or_update(entity_ids, update, rv, workers, pin=not join)
+        except gevent.Timeout as exc:
+            if exc is not timer:
+                raise
             self.logger.warn('Update timeout: %s', entity_ids)
-            raise
+            if not with_timed_out:
+                raise
+            return rv, entity_ids.difference(rv)
         else:
             self.logger.debug('Processing: rv=%s spawned=%s pool=%s',
                 set(rv.keys()) or '{}', [(w.args and w.args[0]) for w in workers], _pool_status(self.pool))
-            timeout.cancel()  # TODO: api?
+        finally:
+            timer.cancel()
 
+        timed_out = set()
         if workers and join:
-            finished_workers = gevent.joinall(workers, timeout=self.join_timeout)
-            if len(workers) != len(finished_workers):
-                self.logger.warn('Join timeout: %d, not finished workers: %s', self.join_timeout,
-                                 [w.args[0] for w in set(workers).difference(finished_workers)])
-            rv_, _ = self._get_or_update(set(entity_ids) - set(rv), update=False)
+            waiting = [id for id in entity_ids.difference(rv) if id in self.workers]
+            join_timeout = (self.join_timeout if deadline is None
+                            else max(0, deadline - time.monotonic()))
+            self._acquire_waiters(waiting)
+            try:
+                finished_workers = gevent.joinall(workers, timeout=join_timeout)
+                not_finished = [w.args[0] for w in set(workers).difference(finished_workers)]
+                # Finished workers are already removed
+                timed_out = {id for id in waiting if id in self.workers}
+            finally:
+                # Orphaned workers may be cancelled here
+                self._release_waiters(waiting)
+            if not_finished:
+                self.logger.warn('Join timeout: %s, not finished workers: %s',
+                                 join_timeout, not_finished)
+            rv_, _ = self._get_or_update(entity_ids.difference(rv), update=False)
             rv.update(rv_)
-        return rv
+            timed_out.difference_update(rv)
+        return (rv, timed_out) if with_timed_out else rv
 
-    def _get_or_update(self, entity_ids, update):
-        rv, workers = {}, []
-        for entity_id in entity_ids:
-            data = self.cache.get(self.cache_key.format(entity_id))
-            if data:
-                rv[entity_id] = data
-            elif data is False:
-                rv[entity_id] = None
-            elif update:
-                workers.append(self.get_or_create_worker(entity_id))
+    def _get_or_update(self, entity_ids, update, rv=None, workers=None, pin=True):
+        """
+        Fills rv {entity_id: value} from cache and workers for missed entities,
+        so partial result is available on timeout.
+        """
+        rv, workers = {} if rv is None else rv, [] if workers is None else workers
+        entity_ids = tuple(entity_ids)
+        cached = self.cache.get_many(*(self.cache_key.format(id) for id in entity_ids))
+        rv_, missed, stale = self._split_cached(entity_ids, cached)
+        rv.update(rv_)
+        if update:
+            for entity_id in missed:
+                worker = self.get_or_create_worker(entity_id)
+                if worker is None:
+                    continue  # circuit breaker is open
+                if pin:
+                    self._pinned.add(entity_id)
+                if worker not in workers:
+                    workers.append(worker)
+            for entity_id in stale:
+                # Background refresh, stale value is returned without waiting.
+                # Skipped if pool is full, so next caller will try again.
+                if entity_id in self.workers or not self.pool.full():
+                    if self.get_or_create_worker(entity_id) is not None:
+                        self._pinned.add(entity_id)
+                        self._refreshing.add(entity_id)
         return rv, workers
 
+    def _cancel_worker(self, worker):
+        worker.kill(block=False)
+
+    def _set_cached(self, rv, delta, fail_timeout=None):
+        for mapping, timeout in self._cache_mappings(rv, delta, fail_timeout):
+            self.cache.set_many(mapping, timeout)
+
+    def _acquire_rate_limiter(self):
+        if self.rate_limiter and not self.rate_limiter.acquire():
+            raise RateLimitExceeded(self.rate_limiter.name)
+
     def get_or_create_worker(self, entity_id):
         if entity_id not in self.workers:
-            self.workers[entity_id] = self.pool.spawn(self.worker, entity_id)
+            ticket = True
+            # Batch worker is checked once on batch creation
+            if not self.batch_size or self._batch is None:
+                ticket = self._allow_worker()
+                if not ticket:
+                    return None
+            if self.batch_size:
+                self._add_to_batch(entity_id)
+            else:
+                self.workers[entity_id] = self.pool.spawn(self.worker, entity_id)
+            self._register_probe(ticket, self.workers[entity_id])
         return self.workers[entity_id]
 
+    def _add_to_batch(self, entity_id):
+        if self._batch is None:
+            entity_ids, full = [], Event()
+            greenlet = self.pool.greenlet_class(self.batch_worker, entity_ids, full)
+            self._batch = (entity_ids, full, greenlet)
+            # Greenlet is registered before pool.start, because pool may block
+            # on waiting free slot and other callers should join same batch
+            self._append_to_batch(entity_id)
+            try:
+                self.pool.start(greenlet)
+            except BaseException:
+                # Greenlet is never started (on timeout, for example),
+                # so it's entities should be fetched again by next callers
+                if self._batch and self._batch[2] is greenlet:
+                    self._batch = None
+                for id in entity_ids:
+                    self._remove_worker(id, greenlet)
+                raise
+        else:
+            self._append_to_batch(entity_id)
+
+    def _append_to_batch(self, entity_id):
+        entity_ids, full, greenlet = self._batch
+        entity_ids.append(entity_id)
+        self.workers[entity_id] = greenlet
+        if len(entity_ids) >= self.batch_size:
+            self._close_batch()
+
+    def _close_batch(self):
+        self._batch[1].set()
+        self._batch = None
+
     def worker(self, entity_id):
         self.logger.debug('Starting worker: %s', entity_id)
+        started_at = time.time()
         try:
+            self._acquire_rate_limiter()
             rv = self._worker(entity_id)
         except Exception as exc:
             self.logger.exception('Worker failed: %s %r', entity_id, exc)
+            self._record_worker(exc, gevent.getcurrent())
+            self._set_cached(self._error_rv([entity_id], exc), time.time() - started_at,
+                             self.cache_error_timeout)
         except BaseException as exc:
             self.logger.debug('Worker failed: %s %r', entity_id, exc)
             raise
         else:
-            timeout = self.cache_fail_timeout if rv is False else self.cache_timeout
-            self.cache.set(self.cache_key.format(entity_id), rv, timeout)
+            self._record_worker(None, gevent.getcurrent())
+            self._set_cached({entity_id: rv}, time.time() - started_at)
         finally:
-            del self.workers[entity_id]
+            self._remove_worker(entity_id, gevent.getcurrent())
 
-    def _worker(self, entity_id):
-        raise NotImplementedError()
+    def batch_worker(self, entity_ids, full):
+        full.wait(self.batch_wait)
+        if self._batch and self._batch[0] is entity_ids:
+            self._close_batch()
+
+        self.logger.debug('Starting batch worker: %s', entity_ids)
+        started_at = time.time()
+        try:
+            self._acquire_rate_limiter()
+            rv = self._batch_worker(entity_ids)
+        except Exception as exc:
+            self.logger.exception('Batch worker failed: %s %r', entity_ids, exc)
+            self._record_worker(exc, gevent.getcurrent())
+            self._set_cached(self._error_rv(entity_ids, exc), time.time() - started_at,
+                             self.cache_error_timeout)
+        except BaseException as exc:
+            self.logger.debug('Batch worker failed: %s %r', entity_ids, exc)
+            raise
+        else:
+            self._record_worker(None, gevent.getcurrent())
+            missed = set(entity_ids).difference(rv)
+            if missed:
+                self.logger.warn('Batch worker missed: %s', missed)
+            self._set_cached(rv, time.time() - started_at)
+        finally:
+            for entity_id in entity_ids:
+                self._remove_worker(entity_id, gevent.getcurrent())
 
 
 class Semaphore(Semaphore):
@@ -146,26 +365,85 @@ class Semaphore(Semaphore):
         self.release()
 
 
-def _create_switch_time_tracer(max_blocking_time, logger):
-    def _switch_time_tracer(what, origin_target):
-        origin, target = origin_target
-        if not hasattr(_switch_time_tracer, '_last_switch_time'):
-            _switch_time_tracer._last_switch_time = None
-        then = _switch_time_tracer._last_switch_time
-        now = _switch_time_tracer._last_switch_time = time.time()
-        if then is not None:
-            blocking_time = now - then
-            if origin is not get_hub():
-                if blocking_time > max_blocking_time:
-                    msg = "Greenlet blocked the eventloop for %.4f seconds\n"
-                    logger.warning(msg, blocking_time)
+class BlockingDetector:
+    """
+    Detects greenlets blocking event loop for more than max_blocking_time seconds.
+    Greenlet switch tracer only records switch time, and watchdog thread (not patched
+    by gevent) samples stack of running greenlet if it's blocking for too long,
+    so blocking is logged with stack and aggregated by call site in histograms.
+    """
+    def __init__(self, max_blocking_time, logger, interval=None):
+        self.max_blocking_time = max_blocking_time
+        self.logger = logger
+        self.interval = interval or max_blocking_time / 2
+        self.sites = defaultdict(Histogram)  # {call site: Histogram}
+        # [last switch time, switched to greenlet, (switch time, call site, stack) sample]
+        self._state = [time.monotonic(), None, None]
+
+    def start(self):
+        greenlet_settrace(self._create_tracer())
+        get_ident = gevent.monkey.get_original('_thread', 'get_ident')
+        start_new_thread = gevent.monkey.get_original('_thread', 'start_new_thread')
+        start_new_thread(self._watch, (get_ident(), get_hub()))
+        return self
+
+    def _create_tracer(self):
+        state, max_blocking_time, hub = self._state, self.max_blocking_time, get_hub()
+        monotonic, report = time.monotonic, self._report
+
+        def tracer(what, origin_target):
+            now, then = monotonic(), state[0]
+            state[0], state[1] = now, origin_target[1]
+            if now - then > max_blocking_time and origin_target[0] is not hub:
+                report(now - then, then)
+
+        return tracer
+
+    def _watch(self, thread_id, hub):
+        sleep = gevent.monkey.get_original('time', 'sleep')
+        state = self._state
+        while True:
+            sleep(self.interval)
+            switched_at = state[0]
+            if (time.monotonic() - switched_at > self.max_blocking_time and
+               state[1] is not hub and (state[2] is None or state[2][0] != switched_at)):
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    stack = traceback.extract_stack(frame)
+                    state[2] = (switched_at, self._get_call_site(stack), stack)
+
+    def _get_call_site(self, stack):
+        # innermost frame outside of gevent and standard library
+        for frame in reversed(stack):
+            if not (frame.filename.startswith(_GEVENT_PATH) or
+                    (frame.filename.startswith(_STDLIB_PATH) and
+                     'site-packages' not in frame.filename)):
+                break
+        else:
+            frame = stack[-1]
+        return '{}:{} {}'.format(frame.filename, frame.lineno, frame.name)
+
+    def _report(self, blocking_time, switched_at):
+        sample = self._state[2]
+        if sample and sample[0] == switched_at:
+            site, stack = sample[1], ''.join(traceback.format_list(sample[2]))
+        else:
+            site, stack = 'unknown', ''
+        self.sites[site].observe(blocking_time)
+        self.logger.warning('Greenlet blocked the eventloop for %.4f seconds at %s\n%s',
+                            blocking_time, site, stack)
 
-    return _switch_time_tracer
+    def stats(self):
+        return {site: histogram.to_dict() for site, histogram in self.sites.items()}
+
+
+_GEVENT_PATH = os.path.dirname(gevent.__file__)
+_STDLIB_PATH = sysconfig.get_paths()['stdlib']
 
 
 def set_switch_time_tracer(max_blocking_time, logger):
     # based on http://www.rfk.id.au/blog/entry/detect-gevent-blocking-with-greenlet-settrace/
-    greenlet_settrace(_create_switch_time_tracer(max_blocking_time, logger))
+    return BlockingDetector(max_blocking_time, logger).start()
 
 
 def set_hub_exception_logger(logger):
@@ -188,10 +466,61 @@ def app_context(app):
     return decorator
 
 
-def app_greenlet_class(app):
+class PooledAppContext(AppContext):
+    """
+    App context with g created on first access.
+    """
+    _g = None
+
+    @property
+    def g(self):
+        if self._g is None:
+            self._g = self.app.app_ctx_globals_class()
+        return self._g
+
+    @g.setter
+    def g(self, value):
+        self._g = value
+
+
+class AppContextPool:
+    """
+    Same as app_context(app) decorator, but app contexts are reused (with url adapter)
+    and g is created only on first access, decreasing overhead for short greenlets.
+    Up to max_size free contexts are kept for reuse.
+    """
+    def __init__(self, app, max_size=1000):
+        self.app = app
+        self.max_size = max_size
+        self._free = []
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                ctx = free.pop()
+            except IndexError:
+                ctx = PooledAppContext(self.app)
+                ctx._g = None
+            ctx.push()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                ctx.pop()
+                ctx._g = None
+                if len(free) < self.max_size:
+                    free.append(ctx)
+
+        free = self._free
+        return wrapper
+
+
+def app_greenlet_class(app, context=None):
+    context = context or app_context(app)
+
     @wraps(Greenlet)
     def wrapper(run, *args, **kwargs):
-        return Greenlet(app_context(app)(run), *args, **kwargs)
+        return Greenlet(context(run), *args, **kwargs)
     return wrapper
 
 
@@ -210,6 +539,294 @@ def greenlet_class(*args, **kwargs):
     current_app.greenlet_class(*args, **kwargs)
 
 
+class InstrumentedPool(Pool):
+    """
+    Pool recording time of waiting for free slot and run time histograms,
+    counters of spawned and failed greenlets, waits on full pool (saturation)
+    and peak occupancy.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.spawned = self.failed = self.waits = self.peak = 0
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+        self._started_at = {}
+
+    def add(self, greenlet, blocking=True, timeout=None):
+        full = self.full()
+        started_at = time.monotonic()
+        super().add(greenlet, blocking, timeout)
+        now = time.monotonic()
+        if full:
+            self.waits += 1
+        self.wait_time.observe(now - started_at)
+        self.spawned += 1
+        self.peak = max(self.peak, len(self))
+        self._started_at[greenlet] = now
+        greenlet.rawlink(self._on_done)
+
+    def _on_done(self, greenlet):
+        self.run_time.observe(time.monotonic() - self._started_at.pop(greenlet))
+        if not greenlet.successful():
+            self.failed += 1
+
+    def status(self):
+        return {
+            'size': self.size,
+            'in_use': len(self),
+            'peak': self.peak,
+            'spawned': self.spawned,
+            'spawn_rate': round(self.spawned / (time.monotonic() - self.created_at), 4),
+            'failed': self.failed,
+            'waits': self.waits,
+            'wait_time': self.wait_time.to_dict(),
+            'run_time': self.run_time.to_dict(),
+        }
+
+
+class AdaptivePool(InstrumentedPool):
+    """
+    Pool with concurrency limit adjusted between min_size and size (gradient style).
+    Limit is updated at most once per cooldown seconds, using average latency of
+    window (at least min_samples greenlets started after last limit change):
+    it's decreased by backoff factor on greenlet failures, decreased proportionally
+    (but not more than by backoff factor) if latency is higher than
+    latency_tolerance * baseline, and increased by one if pool was saturated.
+    Baseline is average latency measured in probe window every probe_interval
+    seconds (and on start), when limit is dropped to probe_ratio * limit.
+    Limit is applied by holding (size - limit) permits of pool semaphore.
+    """
+    def __init__(self, size, greenlet_class=None, min_size=1, latency_tolerance=2.,
+                 backoff=0.9, cooldown=1., min_samples=10, probe_interval=60.,
+                 probe_ratio=0.25):
+        assert size, 'AdaptivePool can\'t be without size'
+        super().__init__(size, greenlet_class=greenlet_class)
+        self.min_size = min_size
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.min_samples = min_samples
+        self.probe_interval = probe_interval
+        self.probe_ratio = probe_ratio
+        self.limit = size
+        self.baseline = None
+        self._reserved = self._debt = 0
+        self._latency_sum, self._samples, self._failures = 0., 0, 0
+        self._saturated = False
+        self._changed_at = self._updated_at = time.monotonic()
+        self._probe_at = None  # next probe, on first update
+        self._probe_limit = None  # limit to restore after probe
+
+    def free_count(self):
+        return max(0, self.limit - len(self))
+
+    def add(self, greenlet, blocking=True, timeout=None):
+        super().add(greenlet, blocking, timeout)
+        if len(self) >= self.limit:
+            self._saturated = True
+
+    def _on_done(self, greenlet):
+        started_at = self._started_at.get(greenlet)
+        super()._on_done(greenlet)
+        if not greenlet.successful():
+            self._failures += 1
+        elif started_at is not None and started_at >= self._changed_at:
+            # Latency of greenlets started before change is not showing current limit
+            self._latency_sum += self.run_time.last
+            self._samples += 1
+
+        now = time.monotonic()
+        if now - self._updated_at >= self.cooldown and (
+                self._failures or self._samples >= self.min_samples):
+            self._update(now)
+        self._pay_debt()
+
+    def _update(self, now):
+        latency = self._samples and self._latency_sum / self._samples
+        failures, saturated = self._failures, self._saturated
+        self._latency_sum, self._samples, self._failures = 0., 0, 0
+        self._saturated = False
+        self._updated_at = now
+
+        if self._probe_limit is not None:
+            limit, self._probe_limit = self._probe_limit, None
+            self._probe_at = now + self.probe_interval
+            if latency:
+                self.baseline = latency
+            self._change_limit(limit * self.backoff if failures else limit, now)
+        elif failures:
+            self._change_limit(self.limit * self.backoff, now)
+        elif self._probe_at is None or now >= self._probe_at:
+            self._probe_limit = self.limit
+            self._change_limit(self.limit * self.probe_ratio, now)
+        elif latency > self.baseline * self.latency_tolerance:
+            gradient = self.baseline * self.latency_tolerance / latency
+            self._change_limit(self.limit * max(self.backoff, gradient), now)
+        elif saturated:
+            self._change_limit(self.limit + 1, now)
+
+    def _change_limit(self, limit, now):
+        limit_ = self.limit
+        self.set_limit(int(limit))
+        if self.limit != limit_:
+            self._changed_at = now
+
+    def set_limit(self, limit):
+        limit = max(self.min_size, min(self.size, limit))
+        reserve = self.size - limit
+        while self._reserved + self._debt < reserve:
+            self._debt += 1
+        while self._reserved + self._debt > reserve:
+            if self._debt:
+                self._debt -= 1
+            else:
+                self._reserved -= 1
+                self._semaphore.release()
+        self.limit = limit
+        self._pay_debt()
+
+    def _pay_debt(self):
+        while self._debt and self._semaphore.acquire(blocking=False):
+            self._debt -= 1
+            self._reserved += 1
+
+    def status(self):
+        rv = super().status()
+        rv.update({'limit': self.limit, 'min_size': self.min_size,
+                   'baseline': self.baseline and round(self.baseline, 4),
+                   'probing': self._probe_limit is not None})
+        return rv
+
+
+class WorkForeverJob:
+    """
+    Runs func in loop until app.stopping is set. Next run is scheduled wait_seconds
+    after previous run is finished, or every wait_seconds from previous scheduled run
+    with fixed_rate, or by cron expression (croniter required). Runs missed on overrun
+    are skipped. Every run is delayed by random jitter up to jitter seconds,
+    so nodes are not running in lockstep. Failures are logged and retried with
+    exponential backoff up to max_backoff seconds. With leader flag func runs only
+    on node holding auto renewed redis lock.
+    """
+    def __init__(self, app, func, name, wait_seconds=0, fixed_rate=False, cron=None,
+                 jitter=0, max_backoff=300, leader=False, leader_timeout=30):
+        assert wait_seconds or not fixed_rate, 'wait_seconds is required for fixed_rate'
+        if cron and croniter is None:
+            raise ImportError('croniter is required for cron schedule')
+        self.app = app
+        self.func = func
+        self.name = name
+        self.wait_seconds = wait_seconds
+        self.fixed_rate = fixed_rate
+        self.cron = cron
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.leader = leader
+        self.leader_timeout = leader_timeout
+
+        self.runs = self.failures = self.consecutive_failures = 0
+        self.overruns = self.skipped = 0
+        self.last_run_at = self.last_error = None
+        self.duration = Histogram()
+        self.lag = Histogram()
+        self._lock = None
+        self._is_leader = False
+
+    def __call__(self):
+        stopping, logger = self.app.stopping, self.app.logger
+        scheduled_at = self._first_run_at(time.time())
+        try:
+            while not stopping.is_set():
+                run_at = scheduled_at + random.uniform(0, self.jitter)
+                delay = run_at - time.time()
+                if delay > 0:
+                    logger.info('work_forever %s sleep for %.1f', self.name, delay)
+                    if stopping.wait(delay):
+                        break
+                started_at = time.time()
+                self.lag.observe(max(0., started_at - run_at))
+                try:
+                    if self._check_leader():
+                        self.runs += 1
+                        self.last_run_at = started_at
+                        self.func()
+                        self.duration.observe(time.time() - started_at)
+                    else:
+                        self.skipped += 1
+                    self.consecutive_failures = 0
+                except Exception as exc:
+                    self.failures += 1
+                    self.consecutive_failures += 1
+                    self.last_error = repr(exc)
+                    backoff = min(self.max_backoff, 2 ** (self.consecutive_failures - 1))
+                    logger.exception('work_forever %s failed, retry in %s seconds: %r',
+                                     self.name, backoff, exc)
+                    scheduled_at = time.time() + backoff
+                else:
+                    scheduled_at = self._next_run_at(scheduled_at, time.time())
+        finally:
+            self._release_leader()
+
+    def _first_run_at(self, now):
+        if self.cron:
+            self._cron = croniter(self.cron, now)
+            return self._cron.get_next(float)
+        return now
+
+    def _next_run_at(self, scheduled_at, now):
+        if self.cron:
+            next_run_at = self._cron.get_next(float)
+        elif self.fixed_rate:
+            next_run_at = scheduled_at + self.wait_seconds
+        else:
+            return now + self.wait_seconds
+
+        skipped = 0
+        while next_run_at < now:
+            skipped += 1
+            next_run_at = (self._cron.get_next(float) if self.cron
+                           else next_run_at + self.wait_seconds)
+        if skipped:
+            self.overruns += skipped
+            self.app.logger.warning('work_forever %s overrun, %s runs skipped',
+                                    self.name, skipped)
+        return next_run_at
+
+    def _check_leader(self):
+        if not self.leader:
+            return True
+        if self._lock is None:
+            self._lock = self.app.extensions['redis'].lock(
+                'WORK_FOREVER:{}'.format(self.name), self.leader_timeout, auto_renew=True)
+        if not self._is_leader or self._lock.lost:
+            self._is_leader = self._lock.acquire(blocking=False)
+        return self._is_leader
+
+    def _release_leader(self):
+        if self._is_leader:
+            self._is_leader = False
+            try:
+                self._lock.release()
+            except Exception as exc:
+                self.app.logger.warning('work_forever %s leader lock release failed: %r',
+                                        self.name, exc)
+
+    def status(self):
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'last_run_at': self.last_run_at and datetime.utcfromtimestamp(self.last_run_at),
+            'last_error': self.last_error,
+            'leader': self._is_leader if self.leader else None,
+            'duration': self.duration.to_dict(),
+            'lag': self.lag.to_dict(),
+        }
+
+
 class GeventFlask(Flask):
     _work_forever = []
 
@@ -218,7 +835,16 @@ class GeventFlask(Flask):
 
         self.started_at = datetime.utcnow()
         self.pools = {}
-        self.greenlet_class = app_greenlet_class(self)
+        # Set on server shutdown, work_forever loops are exiting on it
+        self.stopping = Event()
+        self.work_forever_jobs = OrderedDict()
+        # Decorator to run spawned greenlets in app context
+        if self.config.get('GEVENT_APP_CONTEXT_POOL_SIZE'):
+            self.greenlet_context = AppContextPool(
+                self, self.config['GEVENT_APP_CONTEXT_POOL_SIZE'])
+        else:
+            self.greenlet_context = app_context(self)
+        self.greenlet_class = app_greenlet_class(self, self.greenlet_context)
 
         # if not gevent.monkey.is_module_patched('__builtin__'):
         #     raise RuntimeError('Looks like gevent.monkey is not applied')
@@ -227,59 +853,78 @@ class GeventFlask(Flask):
             db = self.extensions['sqlalchemy'].db
             db.engine.pool._use_threadlocal = True
 
+        self.blocking_detector = None
         switch_trace_seconds = self.config.get('GEVENT_SWITCH_TRACE_SECONDS')
         if switch_trace_seconds:
-            set_switch_time_tracer(switch_trace_seconds, self.logger)
+            self.blocking_detector = set_switch_time_tracer(switch_trace_seconds, self.logger)
 
         set_hub_exception_logger(self.logger)
 
     def spawn(self, func, *args, **kwargs):
-        return gevent.spawn(app_context(self)(func), *args, **kwargs)
+        return gevent.spawn(self.greenlet_context(func), *args, **kwargs)
 
     def spawn_later(self, seconds, func, *args, **kwargs):
-        return gevent.spawn_later(seconds, app_context(self)(func), *args, **kwargs)
+        return gevent.spawn_later(seconds, self.greenlet_context(func), *args, **kwargs)
 
     def greenlet(self, *args, **kwargs):
         return self.greenlet_class(*args, **kwargs)
 
-    def create_pool(self, name=None, size=None):
+    def create_pool(self, name=None, size=None, adaptive=None):
         if not name:
             assert size, 'Anonymous pools can\'t be without size'
             return Pool(size, greenlet_class=self.greenlet_class)
         else:
             assert name not in self.pools, 'Pool {} already created'.format(name.upper())
             size = size or self.config.get('{}_POOL_SIZE'.format(name.upper()))
-            self.pools[name] = Pool(size, greenlet_class=self.greenlet_class)
+            if adaptive is None:
+                adaptive = self.config.get('{}_POOL_ADAPTIVE'.format(name.upper()))
+            if adaptive:
+                min_size = self.config.get('{}_POOL_MIN_SIZE'.format(name.upper()), 1)
+                self.pools[name] = AdaptivePool(size, greenlet_class=self.greenlet_class,
+                                                min_size=min_size)
+            else:
+                self.pools[name] = InstrumentedPool(size, greenlet_class=self.greenlet_class)
             return self.pools[name]
 
-    def work_forever(self, wait_seconds=None):
-        wait_seconds = wait_seconds or self.config.get('WORK_FOREVER_WAIT_SECONDS', 0)
+    def work_forever(self, wait_seconds=None, fixed_rate=False, cron=None, jitter=None,
+                     max_backoff=None, leader=False, name=None):
+        """
+        Use it to run function in loop while server is running, see WorkForeverJob.
+        Defaults are from WORK_FOREVER_WAIT_SECONDS, WORK_FOREVER_JITTER,
+        WORK_FOREVER_MAX_BACKOFF and WORK_FOREVER_LEADER_TIMEOUT config.
+        """
+        config = self.config
 
         def decorator(func):
-            def wrapper():
-                try:
-                    while True:
-                        func()
-                        if wait_seconds:
-                            self.logger.info('work_forever sleep for %s', wait_seconds)
-                            gevent.sleep(wait_seconds)
-                except Exception as exc:
-                    # TODO: stop server and log error
-                    self.logger.exception('work_forever failed: %r', exc)
-                    print(exc, file=sys.stderr)
-                    sys.exit(1)
-            self._work_forever.append(app_context(self)(wrapper))
+            job = WorkForeverJob(
+                self, func, name or func.__name__,
+                wait_seconds=wait_seconds or config.get('WORK_FOREVER_WAIT_SECONDS', 0),
+                fixed_rate=fixed_rate, cron=cron,
+                jitter=config.get('WORK_FOREVER_JITTER', 0) if jitter is None else jitter,
+                max_backoff=max_backoff or config.get('WORK_FOREVER_MAX_BACKOFF', 300),
+                leader=leader, leader_timeout=config.get('WORK_FOREVER_LEADER_TIMEOUT', 30))
+            assert job.name not in self.work_forever_jobs, \
+                'work_forever {} already registered'.format(job.name)
+            self.work_forever_jobs[job.name] = job
+            self._work_forever.append(app_context(self)(job))
+            return func
         return decorator
 
     def stop(self, timeout=None):
         """
         Use it to execute before server teardown.
+        If timeout is set, function is cancelled after timeout seconds.
         """
-        if timeout:
-            raise NotImplementedError()
-
         def decorator(func):
-            self._stop = app_context(self)(func)
+            func = app_context(self)(func)
+            if timeout:
+                @wraps(func)
+                def wrapper():
+                    with gevent.Timeout(timeout):
+                        return func()
+                self._stop = wrapper
+            else:
+                self._stop = func
         return decorator
 
 
@@ -291,39 +936,325 @@ def get_app_status():
     rv = {'started_at': current_app.started_at}
     if 'sqlalchemy' in current_app.extensions:
         rv['sqlalchemy'] = current_app.extensions['sqlalchemy'].db.session.bind.pool.status()
+    if 'redis' in current_app.extensions:
+        rv['redis'] = current_app.extensions['redis'].pool_status()
     for name, pool in current_app.pools.items():
         rv[name + '_pool'] = _pool_status(pool)
+        if isinstance(pool, InstrumentedPool):
+            rv[name + '_pool_metrics'] = pool.status()
+    if current_app.blocking_detector:
+        rv['blocking'] = current_app.blocking_detector.stats()
+    if current_app.work_forever_jobs:
+        rv['work_forever'] = {name: job.status()
+                              for name, job in current_app.work_forever_jobs.items()}
     return rv
 
 
-def serve_forever(app, stop_signals=[signal.SIGTERM, signal.SIGINT], listen=None):
+def get_pools_prometheus_metrics(pools):
+    pools = {name: pool for name, pool in pools.items() if isinstance(pool, InstrumentedPool)}
+
+    def samples(attr):
+        return [({'pool': name}, getattr(pool, attr)) for name, pool in pools.items()]
+
+    return format_prometheus([
+        ('gevent_pool_size', 'gauge', 'Pool size.', samples('size')),
+        ('gevent_pool_limit', 'gauge', 'Pool concurrency limit.',
+         [({'pool': name}, getattr(pool, 'limit', pool.size)) for name, pool in pools.items()]),
+        ('gevent_pool_in_use', 'gauge', 'Running greenlets.',
+         [({'pool': name}, len(pool)) for name, pool in pools.items()]),
+        ('gevent_pool_peak', 'gauge', 'Peak running greenlets.', samples('peak')),
+        ('gevent_pool_spawned_total', 'counter', 'Spawned greenlets.', samples('spawned')),
+        ('gevent_pool_failed_total', 'counter', 'Failed greenlets.', samples('failed')),
+        ('gevent_pool_waits_total', 'counter', 'Spawns waited on full pool.', samples('waits')),
+        ('gevent_pool_wait_seconds', 'histogram', 'Time of waiting for free slot.',
+         samples('wait_time')),
+        ('gevent_pool_run_seconds', 'histogram', 'Greenlet run time.', samples('run_time')),
+    ])
+
+
+def get_work_forever_prometheus_metrics(jobs):
+    def samples(attr):
+        return [({'job': name}, getattr(job, attr)) for name, job in jobs.items()]
+
+    return format_prometheus([
+        ('work_forever_runs_total', 'counter', 'Job runs.', samples('runs')),
+        ('work_forever_failures_total', 'counter', 'Failed job runs.', samples('failures')),
+        ('work_forever_overruns_total', 'counter', 'Runs skipped on overrun.',
+         samples('overruns')),
+        ('work_forever_skipped_total', 'counter', 'Runs skipped as not leader.',
+         samples('skipped')),
+        ('work_forever_duration_seconds', 'histogram', 'Job run time.', samples('duration')),
+        ('work_forever_lag_seconds', 'histogram', 'Job run delay from schedule.',
+         samples('lag')),
+    ])
+
+
+def register_metrics_view(app, rule='/metrics'):
+    @app.route(rule, methods=['GET'])
+    def get_metrics():
+        return app.response_class(get_pools_prometheus_metrics(app.pools) +
+                                  get_work_forever_prometheus_metrics(app.work_forever_jobs),
+                                  mimetype='text/plain; version=0.0.4')
+
+
+class DrainingWSGIHandler(WSGIHandler):
+    """
+    Registers connection in server.idle_handlers while waiting for next request
+    and doesn't wait for next keep-alive request when server is draining.
+    """
+    def handle_one_request(self):
+        if self.server.draining:
+            return None
+        return super().handle_one_request()
+
+    def read_requestline(self):
+        self.server.idle_handlers.add(self)
+        try:
+            return super().read_requestline()
+        finally:
+            self.server.idle_handlers.discard(self)
+
+
+class DrainingWSGIServer(WSGIServer):
+    """
+    WSGIServer with drain method, which stops accepting connections and closes
+    idle keep-alive connections, others are closed after current request.
+    """
+    handler_class = DrainingWSGIHandler
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.draining = False
+        self.idle_handlers = set()
+
+    def drain(self):
+        self.draining = True
+        self.close()
+        for handler in list(self.idle_handlers):
+            try:
+                # Waiting read_requestline gets EOF and connection is closed
+                handler.socket.shutdown(gevent.socket.SHUT_RD)
+            except (AttributeError, OSError):
+                pass
+
+
+def _drain(app, name, greenlets, deadline):
+    """
+    Waits for greenlets (pool or list) to finish until deadline, logging progress.
+    Returns count of greenlets still running.
+    """
+    while True:
+        running = sum(1 for g in greenlets if not g.dead)
+        remaining = deadline - time.monotonic()
+        if not running or remaining <= 0:
+            return running
+        app.logger.info('Draining %s: %s running, %.1f seconds left', name, running, remaining)
+        gevent.joinall(list(greenlets), timeout=min(remaining, 1))
+
+
+def _signal_handler(signum, handler):
+    # gevent.signal was renamed to gevent.signal_handler
+    return (getattr(gevent, 'signal_handler', None) or gevent.signal)(signum, handler)
+
+
+def _bind_socket(address, reuse_port=False, backlog=2048):
+    sock = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_STREAM)
+    sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def serve_forever(app, stop_signals=[signal.SIGTERM, signal.SIGINT], listen=None,
+                  workers=None):
+    """
+    Serves app until stop signal, see _serve. With more than one worker (-w/--workers
+    option or GEVENT_WORKERS config) master process binds socket and forks workers,
+    see _serve_prefork.
+    """
     host, port = (get_argv_opt('-l', '--listen') or listen or
                   app.config.get('GEVENT_LISTEN', '127.0.0.1:8088')).split(':')
-    server = WSGIServer((host, int(port)), app, spawn=app.create_pool('server'))
+    workers = int(get_argv_opt('-w', '--workers') or workers or
+                  app.config.get('GEVENT_WORKERS', 1))
+    if workers > 1:
+        _serve_prefork(app, (host, int(port)), workers, stop_signals)
+    else:
+        _serve(app, (host, int(port)), stop_signals)
+
+
+def _serve(app, listener, stop_signals):
+    server = DrainingWSGIServer(listener, app, spawn=app.create_pool('server'))
+    stopped = Event()
 
     def stop():
         if hasattr(stop, 'stopping'):
             try:
-                app.logger.warn('Multiple exit signals received - aborting.')
+                app.logger.warning('Multiple exit signals received - aborting.')
             finally:
                 return sys.exit('Multiple exit signals received - aborting.')
         stop.stopping = True
 
-        app.logger.info('Stopping server')
-        for worker in app._work_forever:
-            if isinstance(worker, Greenlet):
-                worker.kill(timeout=5)
+        stop_timeout = app.config.get('GEVENT_STOP_TIMEOUT', 30)
+        deadline = time.monotonic() + stop_timeout
+        app.logger.info('Stopping server, drain timeout %s seconds', stop_timeout)
+
+        def phase_deadline(phases_left):
+            # Each phase gets it's part of remaining time, unused time is passed on
+            now = time.monotonic()
+            return now + max(0, deadline - now) / phases_left
+
+        # work_forever loops are not starting new runs while requests are drained
+        app.stopping.set()
+        # Stop accepting connections and close idle keep-alive ones,
+        # so in-flight requests may finish
+        server.drain()
+        cancelled = _drain(app, 'server pool', server.pool, phase_deadline(3))
+
+        workers = [w for w in app._work_forever if isinstance(w, Greenlet)]
+        cancelled += _drain(app, 'work_forever', workers, phase_deadline(2))
+        gevent.killall(workers, timeout=1)
+
         if hasattr(app, '_stop'):
-            app._stop()
+            try:
+                app._stop()
+            except BaseException as exc:
+                app.logger.exception('Stop handler failed: %r', exc)
+
+        for name, pool in app.pools.items():
+            if pool is not server.pool:
+                cancelled += _drain(app, name + ' pool', pool, deadline)
         for pool in app.pools.values():
-            pool.kill(timeout=5)
-        # TODO: we should stop serving requests before app._stop, but for some reason
-        # app._stop is not finishing in this case (maybe timeout?)
-        server.stop(5)
-        app.logger.info('Server stopped')
+            pool.kill(timeout=1)
+        server.stop(timeout=0)
 
-    [gevent.signal(sig, stop) for sig in stop_signals]
+        if cancelled:
+            app.logger.warning('Server stopped, %s greenlets cancelled on drain timeout',
+                               cancelled)
+        else:
+            app.logger.info('Server stopped')
+        stopped.set()
+
+    [_signal_handler(sig, stop) for sig in stop_signals]
 
-    app.logger.info('Starting server on %s:%s', host, port)
+    app.logger.info('Starting server on %s:%s', *server.address[:2])
     app._work_forever = [gevent.spawn(w) for w in app._work_forever]
-    server.serve_forever()
+    server.start()
+    stopped.wait()
+
+
+def _dispose_sqlalchemy_engine(app):
+    """
+    Replaces engine pool in forked worker, so connections opened by master
+    are not shared between workers (and are not closed for master).
+    """
+    if 'sqlalchemy' not in app.extensions:
+        return
+    with app.app_context():
+        engine = app.extensions['sqlalchemy'].db.engine
+        try:
+            engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33
+            engine.pool = engine.pool.recreate()
+
+
+def _restart_delay(failures, uptime, min_uptime, max_delay=30):
+    """
+    Returns (consecutive failed starts, seconds to wait before restart) of exited worker,
+    worker exited before min_uptime seconds is considered failed to start.
+    """
+    failures = failures + 1 if uptime < min_uptime else 0
+    return failures, failures and min(max_delay, 2 ** (failures - 1))
+
+
+def _serve_prefork(app, address, workers, stop_signals):
+    """
+    Master process binds socket once (or every worker binds own socket with
+    SO_REUSEPORT if GEVENT_REUSE_PORT is set), forks workers with own hub and pools,
+    restarts exited workers (with backoff if they are exiting right after start),
+    and forwards first stop signal to workers as SIGTERM for graceful drain,
+    and next one as SIGKILL. Note that work_forever jobs are running in every worker,
+    use leader flag to run job only once.
+    """
+    reuse_port = app.config.get('GEVENT_REUSE_PORT', False)
+    listener = None if reuse_port else _bind_socket(address)
+    children = {}  # {pid: worker number}
+    failures = defaultdict(int)  # {worker number: consecutive failed starts}
+    stopping = []
+    stopped = Event()
+    handlers = []
+
+    def start_worker(number):
+        if stopping:
+            return
+        started_at = time.monotonic()
+        # Child watcher is referenced, so master hub is waiting for workers
+        pid = gevent.os.fork_and_watch(
+            lambda watcher: on_exit(number, started_at, watcher), ref=True)
+        if pid:
+            children[pid] = number
+            return
+
+        # Worker process, master state is not used here anymore
+        children.clear()
+        stopping.append(True)
+        [handler.cancel() for handler in handlers]
+        # Terminal signals are not sent to workers, master is forwarding them
+        os.setpgrp()
+        code = 0
+        try:
+            _dispose_sqlalchemy_engine(app)
+            if app.blocking_detector:
+                app.blocking_detector.start()
+            _serve(app, listener or _bind_socket(address, reuse_port=True), stop_signals)
+        except SystemExit as exc:
+            code = exc.code if isinstance(exc.code, int) else 1
+        except BaseException as exc:
+            app.logger.exception('Worker %s failed: %r', number, exc)
+            code = 1
+        logging.shutdown()
+        os._exit(code)
+
+    def on_exit(number, started_at, watcher):
+        children.pop(watcher.pid, None)
+        if stopping:
+            app.logger.info('Worker %s (pid %s) exited with status %s',
+                            number, watcher.pid, watcher.rstatus)
+            if not children:
+                stopped.set()
+            return
+        failures[number], delay = _restart_delay(
+            failures[number], time.monotonic() - started_at,
+            app.config.get('GEVENT_WORKER_MIN_UPTIME', 10))
+        app.logger.warning('Worker %s (pid %s) exited with status %s, restarting in %s seconds',
+                           number, watcher.pid, watcher.rstatus, delay)
+        gevent.spawn_later(delay, start_worker, number)
+
+    def stop():
+        if stopping:
+            app.logger.warning('Multiple exit signals received - killing workers.')
+            sig = signal.SIGKILL
+        else:
+            app.logger.info('Stopping %s workers', len(children))
+            stopping.append(True)
+            sig = signal.SIGTERM
+            if listener:
+                # Socket is closed when workers are closing their copies on drain
+                listener.close()
+        for pid in list(children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+        if not children:
+            stopped.set()
+
+    handlers.extend(_signal_handler(sig, stop) for sig in stop_signals)
+
+    app.logger.info('Starting %s workers on %s:%s', workers, *address)
+    for number in range(workers):
+        start_worker(number)
+    stopped.wait()
+    app.logger.info('All workers stopped')
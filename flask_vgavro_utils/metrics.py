@@ -0,0 +1,71 @@
+from bisect import bisect_left
+
+
+class Histogram:
+    """
+    Cheap histogram with fixed buckets (upper bounds, in seconds by default).
+    """
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        self.last = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.last = value
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative_counts(self):
+        """
+        Returns [(upper bound, count of values less or equal)], last bound is inf.
+        """
+        rv, count = [], 0
+        for bound, count_ in zip(self.buckets + (float('inf'),), self.counts):
+            count += count_
+            rv.append((bound, count))
+        return rv
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 4),
+            'avg': round(self.sum / self.count, 4) if self.count else 0,
+            'max': round(self.max, 4),
+            'buckets': {str(bound): count for bound, count in self.cumulative_counts()},
+        }
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(key, value)
+                                    for key, value in sorted(labels.items())))
+
+
+def format_prometheus(metrics):
+    """
+    Formats metrics as Prometheus text exposition format.
+    metrics is iterable of (name, type, help, [(labels dict, value or Histogram)]).
+    """
+    lines = []
+    for name, type_, help_, samples in metrics:
+        lines.append('# HELP {} {}'.format(name, help_))
+        lines.append('# TYPE {} {}'.format(name, type_))
+        for labels, value in samples:
+            if isinstance(value, Histogram):
+                for bound, count in value.cumulative_counts():
+                    labels_ = dict(labels, le='+Inf' if bound == float('inf') else bound)
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels_), count))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), value.sum))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), value.count))
+            else:
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
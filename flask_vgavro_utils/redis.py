@@ -1,11 +1,19 @@
+import os
 import inspect
 import functools
 import hashlib
 import pickle
 import time
+import copy
+import uuid
+import logging
+import threading
+import weakref
+from collections import OrderedDict
 
 from flask import current_app
 from redis.client import StrictRedis
+import redis.connection
 try:
     from redis.lock import LuaLock
 except ImportError:
@@ -13,20 +21,62 @@ except ImportError:
     # https://github.com/andymccurdy/redis-py/blob/master/CHANGES
     # TODO: maybe rethink logic due 3.0 changes?
     from redis.lock import Lock as LuaLock
-from redis.exceptions import LockError
+from redis.exceptions import LockError, ResponseError
+
+from .serializers import Serializer
+
+logger = logging.getLogger('flask-vgavro-utils.redis')
 
 
 def create_redis(app):
     redis_url = app.config['REDIS_URL']
+    Redis.connect(
+        redis_url,
+        max_connections=app.config.get('REDIS_MAX_CONNECTIONS'),
+        pool_timeout=app.config.get('REDIS_POOL_TIMEOUT'),
+        socket_keepalive=app.config.get('REDIS_SOCKET_KEEPALIVE'),
+        health_check_interval=app.config.get('REDIS_HEALTH_CHECK_INTERVAL'),
+    )
+    serializer = Serializer(
+        codec=app.config.get('CACHE_CODEC', 'pickle'),
+        compression=app.config.get('CACHE_COMPRESSION'),
+        compress_min_size=app.config.get('CACHE_COMPRESS_MIN_SIZE', 1024),
+    )
     app.extensions['redis'] = Redis(redis_url)
-    app.extensions['cache'] = RedisSerializedCache(redis_url)
-    app.extensions['func_cache'] = RedisSerializedCache(redis_url, 'FUNC_CACHE')
+    if app.config.get('CACHE_LOCAL_MAX_SIZE') or app.config.get('CACHE_LOCAL_MAX_BYTES'):
+        app.extensions['cache'] = TieredCache(
+            redis_url, serializer=serializer,
+            max_size=app.config.get('CACHE_LOCAL_MAX_SIZE'),
+            max_bytes=app.config.get('CACHE_LOCAL_MAX_BYTES'),
+            local_timeout=app.config.get('CACHE_LOCAL_TIMEOUT', 5),
+            invalidate_channel=app.config.get('CACHE_LOCAL_INVALIDATE_CHANNEL'),
+        )
+    else:
+        app.extensions['cache'] = RedisSerializedCache(redis_url, serializer=serializer)
+    app.extensions['func_cache'] = RedisSerializedCache(redis_url, 'FUNC_CACHE', serializer)
     return app.extensions['redis']
 
 
 class RedisLock(LuaLock):
+    """
+    With auto_renew lock is extended to full timeout every timeout * renew_factor
+    seconds in background thread (greenlet if gevent monkey patching is applied)
+    until release. If lock was lost, lost flag is set and on_lost(lock) callback called,
+    holder may also use check() to raise LockError in this case.
+    """
     expire_at = None
 
+    def __init__(self, *args, auto_renew=False, renew_factor=1 / 3, on_lost=None, **kwargs):
+        if auto_renew:
+            # token should be available in renewer thread
+            kwargs['thread_local'] = False
+        super().__init__(*args, **kwargs)
+        self.auto_renew = auto_renew
+        self.renew_factor = renew_factor
+        self.on_lost = on_lost
+        self.lost = False
+        self._renewer_stop = None
+
     def __enter__(self):
         # Redis default lock __enter__ is always blocking
         if not self.acquire():
@@ -37,12 +87,20 @@ class RedisLock(LuaLock):
         rv = super().acquire(*args, **kwargs)
         if rv and self.timeout:
             self.expire_at = time.time() + self.timeout
+            if self.auto_renew:
+                self.lost = False
+                self._start_renewer()
         return rv
 
     def release(self, *args, **kwargs):
+        self._stop_renewer()
         self.expire_at = None
         return super().release(*args, **kwargs)
 
+    def check(self):
+        if self.lost:
+            raise LockError('Lock was lost')
+
     def maybe_extend(self, timeout_factor=0.5):
         if not self.expire_at:
             raise LockError('Lock was not acquired or no timeout')
@@ -58,17 +116,388 @@ class RedisLock(LuaLock):
         super().extend(additional_time)
         self.expire_at += additional_time
 
+    def reacquire(self):
+        super().reacquire()
+        self.expire_at = time.time() + self.timeout
+
+    def _start_renewer(self):
+        self._stop_renewer()
+        self._renewer_stop = threading.Event()
+        threading.Thread(target=self._renew_forever, args=(self._renewer_stop,),
+                         daemon=True).start()
+
+    def _stop_renewer(self):
+        if self._renewer_stop:
+            self._renewer_stop.set()
+            self._renewer_stop = None
+
+    def _renew_forever(self, stop):
+        while not stop.wait(self.timeout * self.renew_factor):
+            try:
+                self.reacquire()
+            except Exception as exc:
+                if stop.is_set():
+                    return
+                expire_at = self.expire_at
+                if not isinstance(exc, LockError) and expire_at and expire_at > time.time():
+                    # connection error, retrying while lock is not expired
+                    logger.warning('Lock renew failed: %s %r', self.name, exc)
+                    continue
+                logger.error('Lock lost: %s %r', self.name, exc)
+                self.lost = True
+                if self.on_lost:
+                    self.on_lost(self)
+                return
+
+
+class RedisSemaphore:
+    """
+    Distributed counting semaphore. Permits are stored in Redis list and waited for
+    with blocking move (Redis 6.2+ required), so idle waiting costs no commands
+    and waiters are served in order of arrival. Holders are registered with unique
+    token in sorted set by expire time (and token to permit hash), permits of expired
+    (crashed) holders are returned on reaping. Blocked waiter is registered as holder
+    without permit, and permit is moved to it's own list, so it's returned by reaping
+    if process is killed before holder registration. Waiters are waking up for reaping
+    on nearest holder expiration (but not more often than reap_interval) and lose
+    their queue position then, so order is FIFO only between reaps.
+    NOTE: every blocked waiter holds Redis connection while waiting.
+    """
+    _init_script = """
+        if redis.call('exists', KEYS[3]) == 0 then
+            redis.call('del', KEYS[1], KEYS[2], KEYS[4])
+            for i = 1, tonumber(ARGV[1]) do
+                redis.call('rpush', KEYS[1], i)
+            end
+            redis.call('set', KEYS[3], ARGV[1])
+        end
+    """
+    # Returns nearest holder expire time
+    _reap_script = """
+        local expired = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1])
+        for _, token in ipairs(expired) do
+            redis.call('zrem', KEYS[2], token)
+            local permit = redis.call('hget', KEYS[3], token)
+            redis.call('hdel', KEYS[3], token)
+            if not permit then
+                -- waiter, permit may be moved to it's list
+                permit = redis.call('lpop', ARGV[2] .. token)
+            end
+            if permit then
+                redis.call('rpush', KEYS[1], permit)
+            end
+        end
+        local nearest = redis.call('zrange', KEYS[2], 0, 0, 'withscores')
+        return nearest[2]
+    """
+    _acquire_script = """
+        local permit = redis.call('lpop', KEYS[1])
+        if not permit then
+            return 0
+        end
+        redis.call('zadd', KEYS[2], ARGV[2], ARGV[1])
+        redis.call('hset', KEYS[3], ARGV[1], permit)
+        return 1
+    """
+    # Registers waiter with permit moved to it's list as holder
+    _register_script = """
+        local permit = redis.call('lpop', KEYS[4])
+        if not permit then
+            return 0
+        end
+        redis.call('zadd', KEYS[2], ARGV[2], ARGV[1])
+        redis.call('hset', KEYS[3], ARGV[1], permit)
+        return 1
+    """
+    _cancel_script = """
+        if redis.call('hexists', KEYS[3], ARGV[1]) == 0 then
+            redis.call('zrem', KEYS[2], ARGV[1])
+        end
+        local permit = redis.call('lpop', KEYS[4])
+        if permit then
+            redis.call('lpush', KEYS[1], permit)
+        end
+    """
+    _release_script = """
+        if redis.call('zrem', KEYS[2], ARGV[1]) == 1 then
+            local permit = redis.call('hget', KEYS[3], ARGV[1])
+            redis.call('hdel', KEYS[3], ARGV[1])
+            if permit then
+                redis.call('rpush', KEYS[1], permit)
+            end
+            return 1
+        end
+        return 0
+    """
+    _extend_script = """
+        if redis.call('hexists', KEYS[2], ARGV[1]) == 1 then
+            redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, redis, name, limit, timeout, blocking=True, blocking_timeout=None,
+                 reap_interval=1):
+        self.redis = redis
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.blocking = blocking
+        self.blocking_timeout = blocking_timeout
+        self.reap_interval = reap_interval
+        self.keys = ['{}:PERMITS'.format(name), '{}:HOLDERS'.format(name),
+                     '{}:LIMIT'.format(name), '{}:TOKENS'.format(name)]
+        self.token = None
+        self._initialized = False
+        self._scripts = {
+            name: redis.register_script(getattr(self, '_{}_script'.format(name)))
+            for name in ('init', 'reap', 'acquire', 'register', 'cancel', 'release', 'extend')
+        }
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockError('Semaphore was not acquired')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _script(self, name, keys, *args):
+        return self._scripts[name](keys=keys, args=args)
+
+    def _waiter_key(self, token):
+        return '{}:WAITER:{}'.format(self.name, token)
+
+    def _reap(self):
+        """
+        Returns nearest holder expire time or None.
+        """
+        if not self._initialized:
+            self._script('init', self.keys, self.limit)
+            self._initialized = True
+        nearest = self._script('reap', [self.keys[0], self.keys[1], self.keys[3]],
+                               time.time(), self._waiter_key(''))
+        return nearest and float(nearest)
+
+    def acquire(self, blocking=None, blocking_timeout=None):
+        if self.token is not None:
+            raise LockError('Semaphore was already acquired')
+        blocking = self.blocking if blocking is None else blocking
+        blocking_timeout = blocking_timeout or self.blocking_timeout
+        deadline = blocking_timeout and (time.time() + blocking_timeout)
+
+        expire_at = self._reap()
+        token = uuid.uuid4().hex
+        keys = [self.keys[0], self.keys[1], self.keys[3], self._waiter_key(token)]
+        acquired = self._script('acquire', keys[:3], token, time.time() + self.timeout)
+        try:
+            while not acquired and blocking:
+                # No need to wake up for reaping before nearest holder expiration
+                wait = max(self.reap_interval, (expire_at or 0) - time.time())
+                if deadline:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        break
+                # Registered as holder without permit until moved permit is registered
+                self.redis.zadd(self.keys[1], {token: time.time() + wait + self.timeout})
+                if self.redis.blmove(self.keys[0], keys[3], wait, 'LEFT', 'LEFT'):
+                    acquired = self._script('register', keys, token,
+                                            time.time() + self.timeout)
+                else:
+                    expire_at = self._reap()
+        finally:
+            if not acquired and blocking:
+                self._script('cancel', keys, token)
+
+        if not acquired:
+            return False
+        self.token = token
+        return True
+
+    def release(self):
+        token, self.token = self.token, None
+        if token is None:
+            raise LockError('Cannot release an unlocked semaphore')
+        if not self._script('release', [self.keys[0], self.keys[1], self.keys[3]], token):
+            raise LockError('Semaphore permit was expired')
+
+    def extend(self, timeout=None):
+        """
+        Sets permit expiration to timeout (or initial timeout) seconds from now.
+        """
+        if self.token is None:
+            raise LockError('Semaphore was not acquired')
+        if not self._script('extend', self.keys[1::2], self.token,
+                            time.time() + (timeout or self.timeout)):
+            raise LockError('Semaphore permit was expired')
+
+
+class RedisFairLock(RedisSemaphore):
+    """
+    Distributed lock with waiters served in order of arrival, see RedisSemaphore.
+    """
+    def __init__(self, redis, name, timeout, **kwargs):
+        super().__init__(redis, name, 1, timeout, **kwargs)
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RedisRateLimiter:
+    """
+    Token bucket rate limiter shared between processes: bucket is refilled with
+    rate tokens per second up to capacity tokens (burst), atomically in Lua script
+    using Redis server time, so clock skew between clients doesn't matter.
+    Blocking acquire is waiting with time.sleep, which is cooperative
+    if gevent monkey patching is applied.
+    May be used as decorator, raising RateLimitExceeded on timeout.
+    """
+    _script = """
+        local rate, capacity, n = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        if redis.replicate_commands then
+            redis.replicate_commands()
+        end
+        local time = redis.call('time')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local bucket = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or capacity
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+        local wait = 0
+        if tokens >= n then
+            tokens = tokens - n
+        else
+            wait = (n - tokens) / rate
+        end
+        redis.call('hmset', KEYS[1], 'tokens', tokens, 'ts', math.max(ts, now))
+        redis.call('pexpire', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+        return tostring(wait)
+    """
+
+    def __init__(self, redis, name, rate, capacity=None, timeout=None):
+        self.redis = redis
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.timeout = timeout
+        self._acquire_script = redis.register_script(self._script)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.acquire():
+                raise RateLimitExceeded(self.name)
+            return func(*args, **kwargs)
+        return wrapper
+
+    def try_acquire(self, n=1):
+        """
+        Returns 0 if n tokens were acquired, or seconds to wait for them otherwise.
+        """
+        assert n <= self.capacity, 'Can\'t acquire more tokens than capacity'
+        return float(self._acquire_script(keys=[self.name], args=[self.rate, self.capacity, n]))
+
+    def acquire(self, n=1, blocking=True, timeout=None):
+        timeout = timeout or self.timeout
+        deadline = timeout and (time.time() + timeout)
+        while True:
+            wait = self.try_acquire(n)
+            if not wait:
+                return True
+            if not blocking or (deadline and time.time() + wait > deadline):
+                return False
+            time.sleep(wait)
+
+
+class _PoolStatsMixin:
+    """
+    Counts waits for connection when pool has no idle connections and
+    max_connections is reached (only BlockingConnectionPool waits,
+    ConnectionPool raises ConnectionError in this case).
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits, self.wait_time, self.max_wait_time = 0, 0., 0.
+
+    def get_connection(self, *args, **kwargs):
+        if self._idle_count() or self._created_count() < self.max_connections:
+            return super().get_connection(*args, **kwargs)
+        started_at = time.monotonic()
+        try:
+            return super().get_connection(*args, **kwargs)
+        finally:
+            wait_time = time.monotonic() - started_at
+            self.waits += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def status(self):
+        created, idle = self._created_count(), self._idle_count()
+        return {
+            'max': self.max_connections,
+            'in_use': created - idle,
+            'idle': idle,
+            'waits': self.waits,
+            'wait_time': round(self.wait_time, 4),
+            'max_wait_time': round(self.max_wait_time, 4),
+        }
+
+
+class ConnectionPool(_PoolStatsMixin, redis.connection.ConnectionPool):
+    def _idle_count(self):
+        return len(self._available_connections)
+
+    def _created_count(self):
+        return self._created_connections
+
+
+class BlockingConnectionPool(_PoolStatsMixin, redis.connection.BlockingConnectionPool):
+    def _idle_count(self):
+        # queue is prefilled with None placeholders for not created connections
+        return sum(1 for connection in tuple(self.pool.queue) if connection is not None)
+
+    def _created_count(self):
+        return len(self._connections)
+
 
 class Redis:
     _redis_map = {}
+    _unlink_unsupported = set()
 
     def __init__(self, redis_url='redis://localhost:6379/0', base_key=None):
         self.base_key = base_key
         self.redis_url = redis_url
         if redis_url not in self._redis_map:
-            self._redis_map[redis_url] = StrictRedis.from_url(redis_url)
+            self.connect(redis_url)
         self._redis = self._redis_map[redis_url]
 
+    @classmethod
+    def connect(cls, redis_url, max_connections=None, pool_timeout=None,
+                socket_keepalive=None, health_check_interval=None):
+        """
+        Creates client shared by all instances with same redis_url, should be called
+        before instances creation to apply connection pool options.
+        With pool_timeout BlockingConnectionPool is used, waiting for free
+        connection up to pool_timeout seconds if max_connections is reached.
+        """
+        kwargs = {key: value for key, value in (
+            ('max_connections', max_connections),
+            ('socket_keepalive', socket_keepalive),
+            ('health_check_interval', health_check_interval),
+        ) if value is not None}
+        if pool_timeout is not None:
+            pool = BlockingConnectionPool.from_url(redis_url, timeout=pool_timeout, **kwargs)
+        else:
+            pool = ConnectionPool.from_url(redis_url, **kwargs)
+        cls._redis_map[redis_url] = StrictRedis(connection_pool=pool)
+        return cls._redis_map[redis_url]
+
+    def pool_status(self):
+        pool = self._redis.connection_pool
+        return pool.status() if isinstance(pool, _PoolStatsMixin) else None
+
     def _build_key(self, key):
         return self.base_key and '{}:{}'.format(self.base_key, key) or key
 
@@ -82,6 +511,54 @@ class Redis:
     def set(self, key, value, timeout=None):
         self._redis.set(self._build_key(key), value, ex=timeout)
 
+    def get_many(self, *keys, default=None):
+        """
+        Returns list of values for keys in same order with one MGET round trip.
+        """
+        if not keys:
+            return []
+        return [default if result is None else result
+                for result in self._redis.mget(*map(self._build_key, keys))]
+
+    def set_many(self, mapping, timeout=None):
+        """
+        Sets all values from mapping {key: value} with one pipelined round trip.
+        """
+        if not mapping:
+            return
+        pipe = self._redis.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(self._build_key(key), value, ex=timeout)
+        pipe.execute()
+
+    def rpush(self, key, *values, timeout=None):
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.rpush(self._build_key(key), *values)
+        if timeout:
+            pipe.expire(self._build_key(key), timeout)
+        return pipe.execute()[0]
+
+    def lpush(self, key, *values, timeout=None):
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.lpush(self._build_key(key), *values)
+        if timeout:
+            pipe.expire(self._build_key(key), timeout)
+        return pipe.execute()[0]
+
+    def lindex(self, key, index, default=None):
+        result = self._redis.lindex(self._build_key(key), index)
+        return result if result is not None else default
+
+    def rename(self, src, dst, timeout=None):
+        """
+        Atomically replaces dst key with src key, setting new timeout if any.
+        """
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.rename(self._build_key(src), self._build_key(dst))
+        if timeout:
+            pipe.expire(self._build_key(dst), timeout)
+        pipe.execute()
+
     def incr(self, key, value):
         self._redis.incr(self._build_key(key), value)
 
@@ -98,18 +575,69 @@ class Redis:
         name = self._build_key('LOCK:{}'.format(name))
         return RedisLock(self._redis, name, timeout, **kwargs)
 
+    def semaphore(self, name, limit, timeout, **kwargs):
+        name = self._build_key('LOCK:SEMAPHORE:{}'.format(name))
+        return RedisSemaphore(self._redis, name, limit, timeout, **kwargs)
+
+    def fair_lock(self, name, timeout, **kwargs):
+        name = self._build_key('LOCK:FAIR:{}'.format(name))
+        return RedisFairLock(self._redis, name, timeout, **kwargs)
+
+    def rate_limiter(self, name, rate, capacity=None, **kwargs):
+        name = self._build_key('RATE_LIMIT:{}'.format(name))
+        return RedisRateLimiter(self._redis, name, rate, capacity, **kwargs)
+
     def flush_locks(self):
-        keys = self._redis.keys(self._build_key('LOCK:*'))
+        return self.delete_pattern('LOCK:*')
+
+    def scan_keys(self, pattern='*', count=1000):
+        """
+        Iterates keys (without base key) with SCAN, not blocking server like KEYS.
+        Keys may be returned more than once.
+        """
+        prefix_len = len(self._build_key(''))
+        for key in self._redis.scan_iter(self._build_key(pattern), count=count):
+            yield key[prefix_len:].decode('utf-8')
+
+    def delete_pattern(self, pattern, count=1000):
+        """
+        Deletes keys matching pattern in batches of count keys
+        with UNLINK (or DEL on Redis < 4.0). Returns number of deleted keys.
+        """
+        rv, keys = 0, []
+        for key in self._redis.scan_iter(self._build_key(pattern), count=count):
+            keys.append(key)
+            if len(keys) >= count:
+                rv += self._unlink(keys)
+                keys = []
         if keys:
-            return self._redis.delete(*keys)
+            rv += self._unlink(keys)
+        return rv
+
+    def _unlink(self, keys):
+        if self.redis_url not in self._unlink_unsupported:
+            try:
+                return self._redis.unlink(*keys)
+            except ResponseError as exc:
+                if 'unknown command' not in str(exc).lower():
+                    raise
+                self._unlink_unsupported.add(self.redis_url)
+        return self._redis.delete(*keys)
 
 
 class RedisSerializedCache(Redis):
+    def __init__(self, redis_url='redis://localhost:6379/0', base_key=None, serializer=None):
+        super().__init__(redis_url, base_key)
+        self.serializer = serializer or Serializer()
+
+    def from_base_key(self, base_key):
+        return self.__class__(self.redis_url, self._build_key(base_key), self.serializer)
+
     def _serialize(self, value):
-        return pickle.dumps(value)
+        return self.serializer.dumps(value)
 
     def _deserialize(self, value):
-        return pickle.loads(value)
+        return self.serializer.loads(value)
 
     def get(self, key, default=None):
         result = super(RedisSerializedCache, self).get(key, None)
@@ -118,112 +646,410 @@ class RedisSerializedCache(Redis):
     def set(self, key, value, timeout=None):
         super(RedisSerializedCache, self).set(key, self._serialize(value), timeout)
 
+    def get_many(self, *keys, default=None):
+        return [default if result is None else self._deserialize(result)
+                for result in super(RedisSerializedCache, self).get_many(*keys)]
+
+    def set_many(self, mapping, timeout=None):
+        super(RedisSerializedCache, self).set_many(
+            {key: self._serialize(value) for key, value in mapping.items()}, timeout)
+
+    def rpush(self, key, *values, timeout=None):
+        return super(RedisSerializedCache, self).rpush(
+            key, *map(self._serialize, values), timeout=timeout)
+
+    def lpush(self, key, *values, timeout=None):
+        return super(RedisSerializedCache, self).lpush(
+            key, *map(self._serialize, values), timeout=timeout)
+
+    def lindex(self, key, index, default=None):
+        result = super(RedisSerializedCache, self).lindex(key, index, None)
+        return default if result is None else self._deserialize(result)
+
+
+# TieredCache instances with invalidation subscriber, restarted in forked child
+_subscribed_caches = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for cache in list(_subscribed_caches):
+        cache._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class TieredCache(RedisSerializedCache):
+    """
+    RedisSerializedCache with bounded in-process LRU in front of it.
+    Local entries live for local_timeout seconds (or less if set with lower timeout),
+    so values may be stale for this time unless invalidate_channel is set -
+    in this case set/delete are published with Redis pub/sub and evicted
+    from local caches of other processes.
+    NOTE: locally cached values are shared between callers and should not be mutated.
+    """
+    def __init__(self, redis_url='redis://localhost:6379/0', base_key=None, serializer=None,
+                 max_size=1000, max_bytes=None, local_timeout=5, invalidate_channel=None):
+        super().__init__(redis_url, base_key, serializer)
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.local_timeout = local_timeout
+        self.invalidate_channel = invalidate_channel
+
+        self._local = OrderedDict()  # {full key: (value, expire_at, size)}
+        self._local_bytes = 0
+        self._local_lock = threading.Lock()
+        self.local_hits = self.local_misses = 0
+
+        self._origin = uuid.uuid4().hex
+        self._pubsub = None
+        if invalidate_channel:
+            self._start_subscriber()
+            _subscribed_caches.add(self)
+
+    def _start_subscriber(self):
+        self._subscriber = threading.Thread(target=self._subscribe, daemon=True)
+        self._subscriber.start()
+
+    def _after_fork(self):
+        # Forked process needs own origin and subscriber connection
+        self._origin = uuid.uuid4().hex
+        self.local_clear()
+        if self._subscriber.is_alive():
+            # Subscriber greenlet survived fork, it will reconnect after disconnect
+            if self._pubsub and self._pubsub.connection:
+                self._pubsub.connection.disconnect()
+        else:
+            self._start_subscriber()
+
+    def from_base_key(self, base_key):
+        # Sharing local cache, it's keyed by full key anyway
+        rv = copy.copy(self)
+        rv.base_key = self._build_key(base_key)
+        return rv
+
+    def _local_get(self, key):
+        with self._local_lock:
+            try:
+                value, expire_at, size = self._local[key]
+            except KeyError:
+                self.local_misses += 1
+                return None
+            if expire_at < time.monotonic():
+                self._local_pop(key)
+                self.local_misses += 1
+                return None
+            self._local.move_to_end(key)
+            self.local_hits += 1
+            return value
+
+    def _local_set(self, key, value, size, timeout=None):
+        timeout = min(timeout, self.local_timeout) if timeout else self.local_timeout
+        with self._local_lock:
+            self._local_pop(key)
+            self._local[key] = (value, time.monotonic() + timeout, size)
+            self._local_bytes += size
+            while self._local and (
+                (self.max_size and len(self._local) > self.max_size) or
+                (self.max_bytes and self._local_bytes > self.max_bytes)
+            ):
+                self._local_bytes -= self._local.popitem(last=False)[1][2]
+
+    def _local_pop(self, key):
+        if key in self._local:
+            self._local_bytes -= self._local.pop(key)[2]
+
+    def local_clear(self):
+        with self._local_lock:
+            self._local.clear()
+            self._local_bytes = 0
+
+    def _invalidate(self, keys):
+        with self._local_lock:
+            for key in keys:
+                self._local_pop(key)
+        if self.invalidate_channel:
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.publish(self.invalidate_channel, '{}:{}'.format(self._origin, key))
+            pipe.execute()
+
+    def _subscribe(self):
+        while True:
+            try:
+                self._pubsub = pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.invalidate_channel)
+                for message in pubsub.listen():
+                    origin, key = message['data'].decode().split(':', 1)
+                    if origin != self._origin:
+                        with self._local_lock:
+                            self._local_pop(key)
+            except Exception as exc:
+                # Messages may be lost while reconnecting, so local entries can't be trusted
+                logger.warning('Cache invalidation subscriber failed: %r', exc)
+                self.local_clear()
+                time.sleep(1)
+
+    def get(self, key, default=None):
+        full_key = self._build_key(key)
+        value = self._local_get(full_key)
+        if value is not None:
+            return value
+        result = Redis.get(self, key)
+        if result is None:
+            return default
+        value = self._deserialize(result)
+        self._local_set(full_key, value, len(result))
+        return value
+
+    def get_many(self, *keys, default=None):
+        rv, missed = [], []
+        for i, key in enumerate(keys):
+            rv.append(self._local_get(self._build_key(key)))
+            if rv[i] is None:
+                missed.append(i)
+        if missed:
+            for i, result in zip(missed, Redis.get_many(self, *(keys[i] for i in missed))):
+                if result is not None:
+                    rv[i] = self._deserialize(result)
+                    self._local_set(self._build_key(keys[i]), rv[i], len(result))
+        return [default if value is None else value for value in rv]
 
-def _get_function_hash_key(func, self_callback=lambda self: None, args=[], kwargs={}):
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
 
-    # getting fully qualified function/method name
-    module = inspect.getmodule(func)
-    module_name = module.__name__
-    class_ = getattr(func, 'im_class', None)
-    class_name = class_ and class_.__name__ or ''
-    method_name = func.__name__
-    func_name = '.'.join((module_name, class_name, method_name))
+    def set_many(self, mapping, timeout=None):
+        if not mapping:
+            return
+        data = {key: self._serialize(value) for key, value in mapping.items()}
+        Redis.set_many(self, data, timeout)
+        self._invalidate([self._build_key(key) for key in mapping])
+        for key, value in mapping.items():
+            self._local_set(self._build_key(key), value, len(data[key]), timeout)
+
+    def delete(self, *keys):
+        rv = super().delete(*keys)
+        self._invalidate([self._build_key(key) for key in keys])
+        return rv
 
-    # getting args/kwargs
-    callargs = inspect.getcallargs(func, *args, **kwargs)
-    argspec = inspect.getargspec(func)
-    nargs = argspec.args
-    argspec.varargs and nargs.append(argspec.varargs)
-    argspec.keywords and nargs.append(argspec.keywords)
-    if inspect.ismethod(func) and func.im_self is not None:
-        # replacing "self" or "cls" with callback if any
-        callargs[nargs[0]] = self_callback(args[0])
-    callargs = pickle.dumps([callargs[arg] for arg in nargs])
+    def _unlink(self, keys):
+        rv = super()._unlink(keys)
+        self._invalidate([key.decode('utf-8') for key in keys])
+        return rv
 
-    key = ':'.join((func_name, callargs))
-    m = hashlib.md5()
-    m.update(key)
-    return m.hexdigest()
+    def flush(self):
+        super().flush()
+        self.local_clear()
 
 
-def cache_function(timeout, self_callback=lambda self: None):
+def _create_function_hash_key(func):
+    """
+    Analyzes function signature once and returns hash_key(args, kwargs) callable,
+    which returns same key for same normalized arguments, for example
+    func(1, 2), func(1, b=2) and func(a=1) with default b=2.
+    """
+    signature = inspect.signature(func)
+    params = tuple(signature.parameters.values())
+    defaults = tuple(param.default for param in params)
+    required = sum(1 for param in params if param.default is param.empty)
+    # fast path without signature.bind for positional arguments only
+    simple = all(param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD)
+                 for param in params)
+    var_keyword = [param.name for param in params if param.kind == param.VAR_KEYWORD]
+    prefix = '{}.{}:'.format(func.__module__, func.__qualname__).encode('utf-8')
+
+    def hash_key(args, kwargs):
+        if simple and not kwargs and required <= len(args) <= len(params):
+            values = tuple(args) + defaults[len(args):]
+        else:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if var_keyword:
+                # **kwargs order should not change key
+                bound.arguments[var_keyword[0]] = tuple(
+                    sorted(bound.arguments[var_keyword[0]].items()))
+            values = tuple(bound.arguments.values())
+        # Protocol is pinned, so keys are not changed with python version
+        return hashlib.md5(prefix + pickle.dumps(values, 4)).hexdigest()
+
+    return hash_key
+
+
+class _Flight(threading.Event):
+    result = None
+
+
+_flights = {}  # {cache_key: _Flight} of calls in progress for single_flight
+
+
+def _call_and_cache(cache, cache_key, timeout, func, args, kwargs):
+    result = func(*args, **kwargs)
+    cache.set(cache_key, result, timeout)
+    return result
+
+
+def _cached_call(cache_key, timeout, single_flight_timeout, func, args, kwargs):
+    cache = current_app.extensions['func_cache']
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
+    if not single_flight_timeout:
+        return _call_and_cache(cache, cache_key, timeout, func, args, kwargs)
+
+    flight = _Flight()
+    leader = _flights.setdefault(cache_key, flight)
+    if leader is not flight:
+        # same call is in progress, waiting for it's result
+        if leader.wait(single_flight_timeout) and leader.result is not None:
+            return leader.result
+        logger.warning('Single flight wait failed, calling locally: %s', cache_key)
+        return _call_and_cache(cache, cache_key, timeout, func, args, kwargs)
+
+    try:
+        flight.result = _locked_call(cache, cache_key, timeout, single_flight_timeout,
+                                     func, args, kwargs)
+        return flight.result
+    finally:
+        del _flights[cache_key]
+        flight.set()
+
+
+def _locked_call(cache, cache_key, timeout, single_flight_timeout, func, args, kwargs):
+    # Other processes are waiting for value on lock instead of calling function
+    lock = cache.lock('SINGLE_FLIGHT:{}'.format(cache_key), single_flight_timeout)
+    if not lock.acquire(blocking_timeout=single_flight_timeout):
+        logger.warning('Single flight lock timeout, calling locally: %s', cache_key)
+        return _call_and_cache(cache, cache_key, timeout, func, args, kwargs)
+    try:
+        result = cache.get(cache_key)
+        if result is None:
+            result = _call_and_cache(cache, cache_key, timeout, func, args, kwargs)
+        return result
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning('Single flight lock expired: %s', cache_key)
+
+
+def cache_function(timeout, self_callback=lambda self: None, single_flight=False,
+                   single_flight_timeout=10):
     """
     Wraps function or bounded method. If this is bounded method - self_callback
     may be passed to get unique cache value for object. Else all methods of same
     class will have common cache.
+    With single_flight concurrent calls on cache miss are waiting for result of first one
+    (other processes are waiting on Redis lock) up to single_flight_timeout seconds,
+    and calling function themselves after it.
     """
     def decorator(func):
+        is_method = inspect.ismethod(func)
+        # for bounded method key is built for underlying function with self_callback value
+        hash_key = _create_function_hash_key(func.__func__ if is_method else func)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            cache_key = _get_function_hash_key(func, self_callback, args, kwargs)
-
-            result = current_app.extensions['func_cache'].get(cache_key)
-            if result is not None:
-                return result
-
-            result = func(*args, **kwargs)
-            current_app.extensions['func_cache'].set(cache_key, result, timeout)
-            return result
+            if is_method:
+                cache_key = hash_key((self_callback(func.__self__),) + args, kwargs)
+            else:
+                cache_key = hash_key(args, kwargs)
+            return _cached_call(cache_key, timeout, single_flight and single_flight_timeout,
+                                func, args, kwargs)
 
         return wrapper
     return decorator
 
 
-def cache_method(timeout, self_callback=lambda self: None):
+def cache_method(timeout, self_callback=lambda self: None, single_flight=False,
+                 single_flight_timeout=10):
     """
     Wraps unbounded method. Instance should be passed to wrapper as first argument.
+    See cache_function for single_flight description.
     """
     def decorator(func):
         # TODO: not obvious when python gives method or when just function...
         assert (not inspect.ismethod(func) and not getattr(func, 'im_self', None))
+        hash_key = _create_function_hash_key(func)
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            args_ = (self_callback(args[0]),) + args[1:]
-            cache_key = _get_function_hash_key(func, args=args_, kwargs=kwargs)
-
-            result = current_app.extensions['func_cache'].get(cache_key)
-            if result is not None:
-                return result
-
-            result = func(*args, **kwargs)
-            current_app.extensions['func_cache'].set(cache_key, result, timeout)
-            return result
+            cache_key = hash_key((self_callback(args[0]),) + args[1:], kwargs)
+            return _cached_call(cache_key, timeout, single_flight and single_flight_timeout,
+                                func, args, kwargs)
 
         return wrapper
     return decorator
 
 
-def cache_method_generator(timeout, self_callback=lambda self: None, cache_on_break=False):
+class CacheReadError(Exception):
+    pass
+
+
+def cache_method_generator(timeout, self_callback=lambda self: None, cache_on_break=False,
+                           chunk_size=100):
     """
     Wraps unbounded method. Instance should be passed to wrapper as first argument.
+    Items are cached by chunks of chunk_size items in Redis list, which is moved to
+    cache key only after generator is finished, so on cache hit items are
+    streamed chunk by chunk without loading whole result.
+    List starts with header (chunks count and write id, also stored in every chunk),
+    so CacheReadError is raised if cached result was expired or replaced while reading
+    (or it's recomputed if nothing was yielded yet).
     """
     def decorator(func):
         # TODO: not obvious when python gives method or when just function...
         assert (not inspect.ismethod(func) and not getattr(func, 'im_self', None))
+        hash_key = _create_function_hash_key(func)
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            args_ = (self_callback(args[0]),) + args[1:]
-            cache_key = _get_function_hash_key(func, args=args_, kwargs=kwargs)
+            cache = current_app.extensions['func_cache']
+            cache_key = hash_key((self_callback(args[0]),) + args[1:], kwargs)
 
-            result = current_app.extensions['func_cache'].get(cache_key)
-            if result is not None:
-                for item in result:
-                    yield item
-                return
+            header = cache.lindex(cache_key, 0)
+            if isinstance(header, dict):
+                for index in range(1, header['chunks'] + 1):
+                    chunk = cache.lindex(cache_key, index)
+                    if chunk is None or chunk[0] != header['id']:
+                        if index == 1:
+                            break
+                        raise CacheReadError('Cached result was expired or replaced: {}'
+                                             .format(cache_key))
+                    yield from chunk[1]
+                else:
+                    return
+
+            # Writing to temporary key not to expose partial result
+            write_id = uuid.uuid4().hex
+            tmp_key, chunk, pushed = '{}:{}'.format(cache_key, write_id), [], 0
+
+            def finish():
+                chunks = pushed
+                if chunk or not pushed:
+                    cache.rpush(tmp_key, [write_id, chunk], timeout=timeout)
+                    chunks += 1
+                cache.lpush(tmp_key, {'chunks': chunks, 'id': write_id}, timeout=timeout)
+                cache.rename(tmp_key, cache_key, timeout)
 
-            result = []
             try:
                 for item in func(*args, **kwargs):
-                    result.append(item)
+                    chunk.append(item)
+                    if len(chunk) >= chunk_size:
+                        cache.rpush(tmp_key, [write_id, chunk], timeout=timeout)
+                        chunk, pushed = [], pushed + 1
                     yield item
             except GeneratorExit:
                 if cache_on_break:
-                    current_app.extensions['func_cache'].set(cache_key, result, timeout)
+                    finish()
+                elif pushed:
+                    cache.delete(tmp_key)
+                raise
+            except BaseException:
+                if pushed:
+                    cache.delete(tmp_key)
                 raise
             else:
-                current_app.extensions['func_cache'].set(cache_key, result, timeout)
+                finish()
 
         return wrapper
     return decorator
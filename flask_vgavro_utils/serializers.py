@@ -0,0 +1,145 @@
+import json
+import pickle
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+class Codec:
+    # First byte of serialized value to identify codec on loading
+    header = None
+
+    def dumps(self, value):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class PickleCodec(Codec):
+    # Pickle protocol 2+ starts with PROTO opcode, so no header is needed,
+    # and values are readable by plain pickle.loads (older versions of this library)
+    header = b'\x80'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        assert protocol >= 2, 'Pickle protocol 2+ required'
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return pickle.dumps(value, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(Codec):
+    header = b'j'
+
+    def dumps(self, value):
+        return self.header + json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data[1:].decode('utf-8'))
+
+
+class MsgpackCodec(Codec):
+    header = b'm'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is required for MsgpackCodec')
+
+    def dumps(self, value):
+        return self.header + msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data[1:], raw=False)
+
+
+class ZlibCompressor(Codec):
+    header = b'z'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def dumps(self, data):
+        return self.header + zlib.compress(data, self.level)
+
+    def loads(self, data):
+        return zlib.decompress(data[1:])
+
+
+class LZ4Compressor(Codec):
+    header = b'l'
+
+    def __init__(self):
+        if lz4 is None:
+            raise ImportError('lz4 is required for LZ4Compressor')
+
+    def dumps(self, data):
+        return self.header + lz4.compress(data)
+
+    def loads(self, data):
+        return lz4.decompress(data[1:])
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec,
+}
+
+COMPRESSORS = {
+    'zlib': ZlibCompressor,
+    'lz4': LZ4Compressor,
+}
+
+COMPRESSOR_HEADERS = {cls.header for cls in COMPRESSORS.values()}
+
+
+class Serializer:
+    """
+    Serializes value with codec, and compresses it if compression is set and
+    serialized value is not less than compress_min_size bytes.
+    Values are loaded by header byte with any known codec or compressor, so values
+    written with different settings may be read side by side (for example during rollout).
+    """
+    def __init__(self, codec='pickle', compression=None, compress_min_size=1024):
+        self.codec = CODECS[codec]() if isinstance(codec, str) else codec
+        self.compressor = (COMPRESSORS[compression]() if isinstance(compression, str)
+                           else compression)
+        self.compress_min_size = compress_min_size
+        self._loaders = {
+            codec.header: codec for codec in (self.codec, self.compressor) if codec
+        }
+
+    def _get_loader(self, header):
+        if header not in self._loaders:
+            for cls in tuple(CODECS.values()) + tuple(COMPRESSORS.values()):
+                if cls.header == header:
+                    self._loaders[header] = cls()
+                    break
+            else:
+                raise ValueError('Unknown serialized value header: {!r}'.format(header))
+        return self._loaders[header]
+
+    def dumps(self, value):
+        data = self.codec.dumps(value)
+        if self.compressor and len(data) >= self.compress_min_size:
+            data = self.compressor.dumps(data)
+        return data
+
+    def loads(self, data):
+        loader = self._get_loader(data[:1])
+        if loader.header in COMPRESSOR_HEADERS:
+            data = loader.loads(data)
+            loader = self._get_loader(data[:1])
+        return loader.loads(data)
@@ -18,14 +18,31 @@ class SyncMixin:
     # date of sync time from userflow
     synced_at = sa.Column(sa.DateTime, nullable=True)
     # Is data changed and userfow need sync?
+    # Only few rows are flagged usually, so partial index is recommended,
+    # see sync_need_index.
     sync_need = sa.Column(sa.Boolean(), nullable=True)
 
 
-def _maybe_to_flat(data):
-    rv = tuple(data)
-    if rv and isinstance(rv[0], (tuple, list, set)):
-        return tuple(x[0] for x in rv)
-    return rv
+def _sync_need_clause(model):
+    # Same expression for index and query, otherwise "IS 1" and "= 1" are rendered
+    # on SQLite and partial index is not used by planner
+    return model.sync_need == sa.true()
+
+
+def sync_need_index(model, id_attr='id', name=None):
+    """
+    Creates partial index on id_attr of rows with sync_need flag, used by
+    Synchronizer.get_ids_for_sync keyset pagination. Call it after model definition,
+    partial index is supported by PostgreSQL and SQLite, other databases get full index.
+    """
+    where = _sync_need_clause(model)
+    return sa.Index(name or 'ix_{}_sync_need'.format(model.__tablename__),
+                    getattr(model, id_attr), postgresql_where=where, sqlite_where=where)
+
+
+def _iter_flat(data):
+    for x in data:
+        yield x[0] if isinstance(x, (tuple, list, set)) else x
 
 
 def _maybe_flat_to_dict(data):
@@ -57,6 +74,7 @@ class Synchronizer:
     getters = {}  # {field name, attr name or callable(instance)
     setters = {}  # {field name, attr name or callable(instance, value)
     allow_create = False
+    ids_batch_size = 1000  # page size of get_ids_for_sync
 
     getter = staticmethod(_synchronizer_meth_decorator('getters'))
     setter = staticmethod(_synchronizer_meth_decorator('setters'))
@@ -169,9 +187,25 @@ class Synchronizer:
             else:
                 return getattr(instance, 'data', {}).get(getter)
 
-    def get_ids_for_sync(self):
-        return (self.session.query(getattr(self.model, self.id_attr))
-                .filter_by(sync_need=True))
+    def get_ids_for_sync(self, batch_size=None):
+        """
+        Yields ids of instances with sync_need flag, queried by pages of batch_size
+        with keyset pagination (id > last id order by id), so ids are not loaded
+        into memory at once. Each page is fetched before yielding, so caller may
+        commit between ids, synced rows are just not matched by next pages.
+        """
+        batch_size = batch_size or self.ids_batch_size
+        column = getattr(self.model, self.id_attr)
+        query = self.session.query(column).filter(_sync_need_clause(self.model))
+        last_id = None
+        while True:
+            page = (query if last_id is None else query.filter(column > last_id))
+            page = page.order_by(column).limit(batch_size).all()
+            for row in page:
+                yield row[0]
+            if len(page) < batch_size:
+                return
+            last_id = page[-1][0]
 
     def finish(self):
         pass
@@ -204,14 +238,21 @@ def synchronize(synchronizers, request, commit=True, batch_size=100, skip={}, **
     unfinished = []
 
     for name, synchronizer in synchronizers.items():
-        for id in (set(_maybe_to_flat(synchronizer.get_ids_for_sync()))
-                   .difference(skip.get(name, []))):
+        skip_ = set(skip.get(name, []))
+        # Ids are streamed, so first batch is sent before all ids are queried,
+        # duplicates are dropped within batch
+        batch_ids = set()
+        for id in _iter_flat(synchronizer.get_ids_for_sync()):
+            if id in skip_ or id in batch_ids:
+                continue
+            batch_ids.add(id)
             data[name].append(id)
             counter += 1
             if counter >= batch_size:
                 _sync_request(data)
                 data = defaultdict(list)
                 counter = 0
+                batch_ids = set()
                 [s.finish() for s in unfinished]
                 unfinished = []
 
@@ -241,10 +282,70 @@ def _repr_payload(synchronizers, data):
     )
 
 
+def _bulk_mappings(instances):
+    """
+    Returns (update mappings, insert mappings) with changed column attributes
+    of persistent instances and set column attributes of pending instances.
+    """
+    updates, inserts = [], []
+    for instance in instances:
+        state = sa.inspect(instance)
+        columns = [attr.key for attr in state.mapper.column_attrs if attr.key in state.dict]
+        if state.pending:
+            inserts.append({key: state.dict[key] for key in columns})
+        elif state.persistent:
+            changed = {key: state.dict[key] for key in columns if key not in state.unmodified}
+            if changed:
+                changed.update(zip((state.mapper.get_property_by_column(column).key
+                                    for column in state.mapper.primary_key), state.identity))
+                updates.append(changed)
+    return updates, inserts
+
+
+def _check_bulk(model):
+    """
+    Bulk mappings are not cascaded to related instances (pending ones reachable
+    by relationships are inserted again by flush), and skip onupdate defaults
+    and version counter, so bulk mode is refused for such models.
+    """
+    mapper = sa.inspect(model)
+    if mapper.relationships:
+        raise ImproperlyConfigured('Bulk sync of model with relationships: %s' % model)
+    if mapper.version_id_col is not None:
+        raise ImproperlyConfigured('Bulk sync of model with version counter: %s' % model)
+    if any(column.onupdate is not None for column in mapper.columns):
+        raise ImproperlyConfigured('Bulk sync of model with onupdate column: %s' % model)
+
+
+def _bulk_save(session, model, instances):
+    """
+    Writes instances changes with executemany INSERT and UPDATE statements
+    instead of unit of work flush, only column attributes are saved.
+    """
+    updates, inserts = _bulk_mappings(instances)
+    for instance in instances:
+        session.expunge(instance)
+    if inserts:
+        session.bulk_insert_mappings(model, inserts)
+    if updates:
+        session.bulk_update_mappings(model, updates)
+
+
 @transaction(commit=True)
-def sync_response(synchronizers, data, session=None):
+def sync_response(synchronizers, data, session=None, bulk=False):
+    """
+    With bulk flag instances are saved with bulk_update_mappings and
+    bulk_insert_mappings, so big batches are committed in few statements.
+    Note that in bulk mode only column attributes changes are saved,
+    changes of other instances (from postprocess, for example) are flushed as usual,
+    and models with relationships, version counter or onupdate columns are refused.
+    """
     if not session:
         session = current_app.extensions['sqlalchemy'].db.session
+    if bulk:
+        for name, synchronizer in synchronizers.items():
+            if name in data:
+                _check_bulk(synchronizer.model)
     logger.debug('Sync response %s', _repr_payload(synchronizers, data))
 
     rv = {'time': datetime.utcnow()}
@@ -255,6 +356,7 @@ def sync_response(synchronizers, data, session=None):
         with session.no_autoflush:
             instance_map = synchronizer.get_instances(data[name].keys())
             rv[name] = {}
+            processed = []
             for id, data_ in data[name].items():
                 try:
                     instance = instance_map[id]
@@ -267,6 +369,9 @@ def sync_response(synchronizers, data, session=None):
                 rv[name][id] = synchronizer.get(instance)
                 synchronizer.postprocess(instance, data=data_)
                 instance.sync_need = False
+                processed.append(instance)
+            if bulk:
+                _bulk_save(session, synchronizer.model, processed)
 
     logger.debug('Sync response send %s', _repr_payload(synchronizers, rv))
     return rv
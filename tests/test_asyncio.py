@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from flask_vgavro_utils.asyncio import AsyncCachedBulkProcessor, AsyncRedisRateLimiter
+
+
+class AsyncDictCache:
+    def __init__(self):
+        self.data = {}
+
+    async def get_many(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    async def set_many(self, mapping, timeout=None):
+        self.data.update(mapping)
+
+
+def test_async_cached_bulk_processor():
+    calls = []
+
+    async def worker(entity_id):
+        calls.append(entity_id)
+        await asyncio.sleep(0.01)
+        return False if entity_id == 3 else entity_id * 2
+
+    async def run():
+        processor = AsyncCachedBulkProcessor(AsyncDictCache(), 'entity:{}', 60,
+                                             worker=worker)
+        rvs = await asyncio.gather(processor(1, 2, join=True), processor(2, 3, join=True))
+        assert rvs == [{1: 2, 2: 4}, {2: 4, 3: None}]
+        assert await processor(1, 2, 3) == {1: 2, 2: 4, 3: None}
+
+    asyncio.run(run())
+    assert sorted(calls) == [1, 2, 3]
+
+
+def test_async_cached_bulk_processor_rate_limited():
+    fakeredis = pytest.importorskip('fakeredis.aioredis')
+    calls = []
+
+    async def worker(entity_id):
+        calls.append(entity_id)
+        return entity_id
+
+    async def run():
+        limiter = AsyncRedisRateLimiter(fakeredis.FakeRedis(), 'limiter', 1, timeout=0.1)
+        cache = AsyncDictCache()
+        processor = AsyncCachedBulkProcessor(cache, 'entity:{}', 60, worker=worker,
+                                             cache_error_timeout=60, rate_limiter=limiter)
+        rv = await processor(*range(1, 11), join=True)
+        assert len(calls) == len(rv) == len(cache.data) == 1
+        assert await limiter.try_acquire() > 0.5
+
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+import time
+
+from flask_vgavro_utils.bulk import CircuitBreaker
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=0.5, min_calls=4, reset_timeout=0.05)
+    for failed in (True, False, True):
+        assert breaker.allow()
+        breaker.record(failed)
+    assert breaker.state == breaker.CLOSED
+    breaker.record(True)
+    assert breaker.state == breaker.OPEN and not breaker.allow()
+
+    time.sleep(0.05)
+    ticket = breaker.allow()
+    assert ticket == breaker.PROBE
+    assert not breaker.allow()
+    breaker.record(True, ticket)
+    assert breaker.state == breaker.OPEN
+
+    time.sleep(0.05)
+    ticket = breaker.allow()
+    breaker.record(False, ticket)
+    assert breaker.state == breaker.CLOSED and breaker.allow()
+    assert breaker.rejected == 2
+
+
+def test_circuit_breaker_ignores_calls_started_before_open():
+    breaker = CircuitBreaker(threshold=0.5, min_calls=4, reset_timeout=0.05)
+    tickets = [breaker.allow() for _ in range(8)]
+    for ticket in tickets[:4]:
+        breaker.record(True, ticket)
+    assert breaker.state == breaker.OPEN
+    # in-flight calls finished after open are not closing circuit
+    breaker.record(False, tickets[4])
+    assert breaker.state == breaker.OPEN and not breaker.allow()
+
+    time.sleep(0.05)
+    probe = breaker.allow()
+    breaker.record(False, tickets[5])
+    assert breaker.state == breaker.HALF_OPEN and not breaker.allow()
+    breaker.record(False, probe)
+    assert breaker.state == breaker.CLOSED
@@ -0,0 +1,355 @@
+import time
+import random
+import logging
+
+import pytest
+import greenlet
+import gevent
+import gevent.socket
+from gevent.pool import Pool
+from flask import current_app, g
+
+from flask_vgavro_utils.gevent import (
+    LockedFactoryDict, AdaptivePool, AppContextPool, BlockingDetector, GeventFlask,
+    InstrumentedPool, WorkForeverJob, CachedBulkProcessor, DrainingWSGIServer,
+    get_pools_prometheus_metrics, _restart_delay)
+from flask_vgavro_utils.redis import Redis, RedisRateLimiter
+
+
+def test_locked_factory_dict():
+    calls = []
+
+    def factory(key):
+        calls.append(key)
+        gevent.sleep(0.01)
+        return key * 2
+
+    data = LockedFactoryDict(factory, max_size=2)
+    greenlets = [gevent.spawn(data.__getitem__, 1) for _ in range(3)]
+    gevent.joinall(greenlets)
+    assert [g.value for g in greenlets] == [2, 2, 2]
+    assert calls == [1]
+    assert data.stats()['waits'] == 2
+
+    data[2], data[1], data[3]
+    assert list(data) == [1, 3]
+    assert data.get(2) is None and data.evictions == 1
+
+
+def test_locked_factory_dict_errors():
+    calls = []
+
+    def factory(key):
+        calls.append(key)
+        raise ValueError(key)
+
+    data = LockedFactoryDict(factory, error_timeout=10)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            data[1]
+    assert calls == [1]
+    assert 1 not in data and data.errors == 1
+
+
+def test_locked_factory_dict_errors_are_bounded():
+    def factory(key):
+        raise ValueError(key)
+
+    data = LockedFactoryDict(factory, max_size=2, error_timeout=0.05)
+    for key in range(5):
+        with pytest.raises(ValueError):
+            data[key]
+    assert list(data._errors) == [3, 4]
+
+    # raised exception is copy without traceback of previous raises
+    errors = []
+    for _ in range(3):
+        try:
+            data[4]
+        except ValueError as exc:
+            errors.append(exc)
+    assert errors[0] is not errors[1] and errors[1].args == (4,)
+    assert data._errors[4][0].__traceback__ is None
+
+    # retried after timeout with doubled timeout, forgotten after it
+    gevent.sleep(0.05)
+    with pytest.raises(ValueError):
+        data[4]
+    assert data._errors[4][3] == 2
+    gevent.sleep(0.2)
+    assert data._get_error(4) is None and 4 not in data._errors
+
+
+def test_adaptive_pool_limit():
+    pool = AdaptivePool(10, min_size=2, cooldown=0)
+    pool.set_limit(4)
+    assert pool.limit == 4 and pool.free_count() == 4
+    assert pool._semaphore.counter == 4
+
+    def fail():
+        raise ValueError()
+
+    pool.spawn(fail).join()
+    assert pool.limit == 3
+    pool.set_limit(100)
+    assert pool.limit == 10 and pool._semaphore.counter == 10
+
+
+def _run_adaptive_pool(pool, latency, seconds):
+    in_flight = []
+
+    def task():
+        in_flight.append(1)
+        try:
+            gevent.sleep(latency(len(in_flight)))
+        finally:
+            in_flight.pop()
+
+    def producer():
+        while True:
+            pool.spawn(task)
+
+    producers = [gevent.spawn(producer) for _ in range(pool.size * 2)]
+    gevent.sleep(seconds)
+    gevent.killall(producers)
+    pool.kill()
+
+
+def test_adaptive_pool_load_dependent_latency():
+    with pytest.raises(AssertionError):
+        AdaptivePool(None)
+
+    # upstream capacity is 10 concurrent calls, latency grows linearly above it
+    pool = AdaptivePool(50, min_size=2, cooldown=0.05, probe_interval=0.5)
+    _run_adaptive_pool(pool, lambda n: 0.01 * max(1, n / 10), 2)
+    assert 10 <= pool.limit <= 30
+    assert 0.01 <= pool.baseline < 0.02
+
+    # latency jitter of healthy upstream is not decreasing limit
+    pool = AdaptivePool(50, cooldown=0.01)
+    _run_adaptive_pool(pool, lambda n: random.uniform(0.001, 0.01), 1)
+    assert pool.limit >= 40
+
+
+def test_work_forever_job_schedule():
+    app = GeventFlask(__name__)
+    app.configure()
+    job = WorkForeverJob(app, lambda: None, 'job', wait_seconds=10)
+    assert job._next_run_at(100, 105) == 115
+
+    job = WorkForeverJob(app, lambda: None, 'job', wait_seconds=10, fixed_rate=True)
+    assert job._next_run_at(100, 105) == 110
+    assert job._next_run_at(100, 125) == 130
+    assert job.overruns == 2
+
+
+def test_blocking_detector():
+    detector = BlockingDetector(0.05, logging.getLogger(), interval=0.01).start()
+    try:
+        def block():
+            time.sleep(0.2)
+
+        gevent.spawn(block).join()
+    finally:
+        greenlet.settrace(None)
+    stats = detector.stats()
+    site, = stats
+    assert site.endswith(' block') and 'test_gevent.py' in site
+    assert stats[site]['count'] == 1 and stats[site]['max'] >= 0.2
+
+
+def test_app_context_pool():
+    app = GeventFlask(__name__)
+    app.config['GEVENT_APP_CONTEXT_POOL_SIZE'] = 1
+    app.configure()
+    pool = app.greenlet_context
+    assert isinstance(pool, AppContextPool)
+    seen = []
+
+    def func(seconds):
+        seen.append((current_app._get_current_object(), 'x' in g))
+        g.x = 1
+        gevent.sleep(seconds)
+
+    app.spawn(func, 0).join()
+    ctx, = pool._free
+    app.spawn(func, 0).join()
+    assert pool._free == [ctx] and ctx._g is None
+
+    # contexts are created for concurrent greenlets, but only max_size are kept
+    gevent.joinall([app.spawn(func, 0.01) for _ in range(3)])
+    assert len(pool._free) == 1
+    assert seen == [(app, False)] * 5
+
+
+def test_instrumented_pool_metrics():
+    app = GeventFlask(__name__)
+    app.configure()
+    pool = app.create_pool('worker', size=2)
+    assert isinstance(pool, InstrumentedPool)
+
+    def fail():
+        raise ValueError()
+
+    greenlets = [pool.spawn(gevent.sleep, 0.01), pool.spawn(fail), pool.spawn(gevent.sleep, 0)]
+    gevent.joinall(greenlets)
+    status = pool.status()
+    assert status['size'] == 2 and status['in_use'] == 0 and status['peak'] == 2
+    assert status['spawned'] == 3 and status['failed'] == 1 and status['waits'] == 1
+    assert status['run_time']['count'] == status['wait_time']['count'] == 3
+
+    metrics = get_pools_prometheus_metrics(app.pools).splitlines()
+    assert '# TYPE gevent_pool_spawned_total counter' in metrics
+    assert 'gevent_pool_spawned_total{pool="worker"} 3' in metrics
+    assert 'gevent_pool_failed_total{pool="worker"} 1' in metrics
+    assert 'gevent_pool_limit{pool="worker"} 2' in metrics
+    assert 'gevent_pool_run_seconds_count{pool="worker"} 3' in metrics
+    assert 'gevent_pool_run_seconds_bucket{le="+Inf",pool="worker"} 3' in metrics
+
+
+class FakeStopping:
+    def __init__(self, waits):
+        self.waits, self.delays = waits, []
+
+    def is_set(self):
+        return len(self.delays) >= self.waits
+
+    def wait(self, delay):
+        self.delays.append(delay)
+        return False
+
+
+def test_work_forever_job_failure_backoff():
+    app = GeventFlask(__name__)
+    app.configure()
+    app.stopping = FakeStopping(4)
+    calls = []
+
+    def func():
+        calls.append(len(calls))
+        if len(calls) <= 3:
+            raise ValueError(len(calls))
+
+    job = WorkForeverJob(app, func, 'job', wait_seconds=10, max_backoff=3)
+    job()
+    assert app.stopping.delays == pytest.approx([1, 2, 3, 10], abs=0.1)
+    assert len(calls) == job.runs == 5
+    assert job.failures == 3 and job.consecutive_failures == 0
+    assert job.last_error == 'ValueError(3)'
+
+
+def test_work_forever_job_leader(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    monkeypatch.setitem(Redis._redis_map, 'redis://fake/0', fakeredis.FakeStrictRedis())
+    app = GeventFlask(__name__)
+    app.configure()
+    app.extensions['redis'] = Redis('redis://fake/0')
+    leader, follower = (WorkForeverJob(app, lambda: None, 'job', wait_seconds=10, leader=True)
+                        for _ in range(2))
+    assert leader._check_leader() and leader._check_leader()
+
+    app.stopping = FakeStopping(1)
+    follower()
+    assert follower.runs == 0 and follower.skipped == 2
+    assert follower.status()['leader'] is False
+
+    leader._release_leader()
+    assert follower._check_leader() and follower.status()['leader']
+    follower._release_leader()
+
+
+def test_work_forever_job_cron():
+    pytest.importorskip('croniter')
+    app = GeventFlask(__name__)
+    app.configure()
+    job = WorkForeverJob(app, lambda: None, 'job', cron='*/5 * * * *')
+    started_at = 1577880060  # 2020-01-01 12:01 UTC
+    first = job._first_run_at(started_at)
+    assert first % 300 == 0 and first - started_at == 240
+    assert job._next_run_at(first, first + 1) == first + 300
+    assert job._next_run_at(first + 300, first + 1260) == first + 1500
+    assert job.overruns == 3
+
+
+def test_prefork_worker_restart_delay():
+    assert _restart_delay(0, 1, 10) == (1, 1)
+    assert _restart_delay(1, 1, 10) == (2, 2)
+    assert _restart_delay(3, 1, 10) == (4, 8)
+    assert _restart_delay(6, 1, 10) == (7, 30)
+    assert _restart_delay(6, 20, 10) == (0, 0)
+
+
+class DictCache(dict):
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping, timeout=None):
+        self.update(mapping)
+
+
+def test_cached_bulk_processor_timeout():
+    def worker(entity_id):
+        gevent.sleep(0.01 if entity_id == 1 else 10)
+        return entity_id * 2
+
+    processor = CachedBulkProcessor(Pool(10), DictCache(), 'entity:{}', 60, worker=worker,
+                                    cancel_orphans=True, logger=logging.getLogger())
+    background = processor(3)
+    assert background == {}
+    rv, timed_out = processor(1, 2, 3, join=True, timeout=0.1, with_timed_out=True)
+    assert rv == {1: 2} and timed_out == {2, 3}
+    # worker for 3 is not cancelled, it was requested without join
+    assert list(processor.workers) == [3] and processor.orphans_cancelled == 1
+    processor.workers[3].kill()
+
+
+def test_cached_bulk_processor_batch_not_started():
+    pool = Pool(1)
+    busy = pool.spawn(gevent.sleep, 0.2)
+    processor = CachedBulkProcessor(pool, DictCache(), 'entity:{}', 60, update_timeout=0.1,
+                                    batch_size=10, batch_worker=lambda ids: {id: id for id in ids},
+                                    logger=logging.getLogger())
+    with pytest.raises(gevent.Timeout):
+        processor(1, 2)
+    assert processor.workers == {} and processor._batch is None
+
+    busy.join()
+    assert processor(1, 2, join=True) == {1: 1, 2: 2}
+
+
+def test_cached_bulk_processor_rate_limited():
+    fakeredis = pytest.importorskip('fakeredis')
+    calls = []
+
+    def worker(entity_id):
+        calls.append(entity_id)
+        return entity_id
+
+    limiter = RedisRateLimiter(fakeredis.FakeStrictRedis(), 'limiter', 1, timeout=0.1)
+    cache = DictCache()
+    processor = CachedBulkProcessor(Pool(10), cache, 'entity:{}', 60, worker=worker,
+                                    cache_error_timeout=60, rate_limiter=limiter,
+                                    logger=logging.getLogger())
+    rv = processor(*range(1, 11), join=True)
+    assert len(calls) == len(rv) == len(cache) == 1
+
+
+def test_draining_wsgi_server_closes_idle_keep_alive():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Length', '2')])
+        return [b'ok']
+
+    server = DrainingWSGIServer(('127.0.0.1', 0), app, spawn=Pool(10), log=None)
+    server.start()
+    client = gevent.socket.create_connection(server.address[:2])
+    client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    assert client.recv(1024).startswith(b'HTTP/1.1 200')
+    gevent.sleep(0.01)
+    assert len(server.idle_handlers) == 1
+
+    server.drain()
+    with gevent.Timeout(1):
+        assert client.recv(1024) == b''
+    gevent.joinall(list(server.pool), timeout=1)
+    assert not server.idle_handlers and not len(server.pool)
+    server.stop()
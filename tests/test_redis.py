@@ -0,0 +1,252 @@
+import time
+import threading
+
+import pytest
+from flask import Flask
+from redis.exceptions import LockError, ResponseError
+
+from flask_vgavro_utils.redis import (
+    _create_function_hash_key, _after_fork_in_child, BlockingConnectionPool, Redis,
+    RedisSemaphore, RedisSerializedCache, TieredCache, cache_function,
+    cache_method_generator, CacheReadError)
+
+
+def test_function_hash_key():
+    def func(a, b=2, *args, **kwargs):
+        pass
+
+    hash_key = _create_function_hash_key(func)
+    assert hash_key((1,), {}) == hash_key((1, 2), {}) == hash_key((), {'a': 1, 'b': 2})
+    assert hash_key((1, 2, 3), {}) != hash_key((1, 2), {})
+    assert hash_key((1,), {'x': 1, 'y': 2}) == hash_key((1,), {'y': 2, 'x': 1})
+    assert hash_key((1,), {'x': 1}) != hash_key((1,), {'x': 2})
+
+    def other_func(a, b=2):
+        pass
+
+    assert _create_function_hash_key(other_func)((1,), {}) != hash_key((1,), {})
+
+    # key is stable between python versions
+    other_func.__module__, other_func.__qualname__ = 'module', 'func'
+    assert _create_function_hash_key(other_func)((1,), {}) == '8f3d98c8ded3eab4e6bb113433b2b000'
+
+
+@pytest.fixture
+def redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def redis_url(redis, monkeypatch):
+    monkeypatch.setitem(Redis._redis_map, 'redis://fake/0', redis)
+    return 'redis://fake/0'
+
+
+def test_redis_semaphore_expired_holder(redis):
+    a, b, c = (RedisSemaphore(redis, 'sem', 1, 0.1, blocking=False) for _ in range(3))
+    assert a.acquire()
+    time.sleep(0.15)
+    assert b.acquire()
+    # expired holder is not releasing permit of new holder
+    with pytest.raises(LockError):
+        a.release()
+    with pytest.raises(LockError):
+        a.extend()
+    assert not c.acquire()
+    b.release()
+    assert c.acquire()
+
+
+def test_redis_semaphore_waits_for_holder_expiration(redis):
+    a, b = RedisSemaphore(redis, 'sem', 1, 1.5), RedisSemaphore(redis, 'sem', 1, 1)
+    assert a.acquire()
+    started_at = time.time()
+    assert b.acquire(blocking_timeout=5)
+    assert 1.5 <= time.time() - started_at < 3
+    assert redis.zcard('sem:HOLDERS') == redis.hlen('sem:TOKENS') == 1
+
+
+def test_cache_method_generator_expired_while_reading(redis, monkeypatch):
+    app = Flask(__name__)
+    monkeypatch.setitem(Redis._redis_map, 'redis://fake/0', redis)
+    app.extensions['func_cache'] = RedisSerializedCache('redis://fake/0', 'FUNC_CACHE')
+    calls = []
+
+    class Service:
+        @cache_method_generator(60, chunk_size=2)
+        def items(self, count):
+            calls.append(count)
+            yield from range(count)
+
+    with app.app_context():
+        assert list(Service.items(Service(), 5)) == list(range(5))
+        assert list(Service.items(Service(), 5)) == list(range(5))
+        assert calls == [5]
+
+        items = Service.items(Service(), 5)
+        assert [next(items), next(items), next(items)] == [0, 1, 2]
+        redis.flushall()
+        with pytest.raises(CacheReadError):
+            list(items)
+        # recomputed after expiration
+        assert list(Service.items(Service(), 5)) == list(range(5))
+        assert calls == [5, 5]
+
+
+def test_redis_semaphore_subsecond_blocking_timeout(redis):
+    a, b = RedisSemaphore(redis, 'sem', 1, 10), RedisSemaphore(redis, 'sem', 1, 10)
+    assert a.acquire()
+    started_at = time.time()
+    assert not b.acquire(blocking_timeout=0.2)
+    assert time.time() - started_at < 0.5
+    # waiter registration is cancelled
+    assert redis.zcard('sem:HOLDERS') == redis.hlen('sem:TOKENS') == 1
+
+
+def test_redis_semaphore_reaps_permit_of_dead_waiter(redis):
+    semaphore = RedisSemaphore(redis, 'sem', 1, 10, blocking=False)
+    semaphore._reap()
+    # waiter was killed after permit was moved to it's list, before registration
+    redis.zadd('sem:HOLDERS', {'dead': time.time() + 0.1})
+    redis.lmove('sem:PERMITS', 'sem:WAITER:dead', 'LEFT', 'LEFT')
+    assert not semaphore.acquire()
+    time.sleep(0.15)
+    assert semaphore.acquire()
+    assert redis.llen('sem:WAITER:dead') == 0
+
+
+def test_tiered_cache_after_fork(redis, monkeypatch):
+    monkeypatch.setitem(Redis._redis_map, 'redis://fake/0', redis)
+    cache = TieredCache('redis://fake/0', 'TIERED', invalidate_channel='invalidate')
+    cache.set('key', 1)
+    assert cache.get('key') == 1 and cache._local
+    origin = cache._origin
+    _after_fork_in_child()
+    assert cache._origin != origin and not cache._local
+
+
+def test_serialized_cache_get_many_set_many(redis, redis_url):
+    cache = RedisSerializedCache(redis_url, 'CACHE')
+    assert cache.get_many() == []
+    cache.set_many({})
+    cache.set_many({'a': {'x': 1}, 'b': [1, 2]}, timeout=60)
+    assert cache.get_many('a', 'missing', 'b', default=0) == [{'x': 1}, 0, [1, 2]]
+    assert cache.from_base_key('OTHER').get_many('a') == [None]
+    assert 0 < redis.ttl('CACHE:a') <= 60
+
+
+def test_tiered_cache_local_hits_and_invalidation(redis, redis_url):
+    a, b = (TieredCache(redis_url, 'TIERED', max_size=2, invalidate_channel='invalidate')
+            for _ in range(2))
+    a.set('x', 1)
+    assert b.get('x') == 1 and b.get('x') == 1
+    assert b.local_misses == 1 and b.local_hits == 1
+    assert b.get_many('x', 'missing', default=0) == [1, 0]
+
+    # change in other process is published and evicted from local cache
+    redis.set('TIERED:x', b.serializer.dumps(2))
+    assert b.get('x') == 1
+    a.set('x', 3)
+    deadline = time.time() + 1
+    while b.get('x') != 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert b.get('x') == 3
+
+    # local cache is bounded by max_size, least recently used entry is evicted
+    b.set_many({'y': 1, 'z': 2})
+    assert list(b._local) == ['TIERED:y', 'TIERED:z']
+    b.delete('y')
+    assert b.get('y') is None and 'TIERED:y' not in b._local
+
+
+def test_cache_function_single_flight(redis_url):
+    app = Flask(__name__)
+    app.extensions['func_cache'] = RedisSerializedCache(redis_url, 'FUNC_CACHE')
+    calls = []
+
+    @cache_function(60, single_flight=True)
+    def func(x):
+        calls.append(x)
+        time.sleep(0.1)
+        return x * 2
+
+    def call(results):
+        with app.app_context():
+            results.append(func(1))
+
+    results = []
+    threads = [threading.Thread(target=call, args=(results,)) for _ in range(5)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert results == [2] * 5 and calls == [1]
+    with app.app_context():
+        assert func(1) == 2 and calls == [1]
+
+
+def test_scan_keys_and_delete_pattern(redis, redis_url):
+    cache = Redis(redis_url, 'BASE')
+    for i in range(25):
+        cache.set('item:{}'.format(i), i)
+    cache.set('other', 1)
+    redis.set('item:outside', 1)
+    lock = cache.lock('name', 10)
+    lock.acquire()
+
+    keys = set(cache.scan_keys('item:*', count=10))
+    assert keys == {'item:{}'.format(i) for i in range(25)}
+    assert cache.flush_locks() == 1
+    assert cache.delete_pattern('item:*', count=10) == 25
+    assert list(cache.scan_keys()) == ['other']
+    assert redis.exists('item:outside')
+
+
+def test_delete_pattern_without_unlink(redis, redis_url, monkeypatch):
+    def unlink(*keys):
+        raise ResponseError("unknown command 'UNLINK'")
+
+    monkeypatch.setattr(redis, 'unlink', unlink)
+    monkeypatch.setattr(Redis, '_unlink_unsupported', set())
+    cache = Redis(redis_url)
+    cache.set_many({'a': 1, 'b': 2})
+    assert cache.delete_pattern('*') == 2
+    assert Redis._unlink_unsupported == {redis_url}
+
+
+def test_blocking_connection_pool_status():
+    fakeredis = pytest.importorskip('fakeredis')
+    connection_class = getattr(fakeredis, 'FakeRedisConnection', fakeredis.FakeConnection)
+    pool = BlockingConnectionPool(connection_class=connection_class,
+                                  server=fakeredis.FakeServer(), max_connections=1, timeout=1)
+    assert pool.status() == {'max': 1, 'in_use': 0, 'idle': 0, 'waits': 0,
+                             'wait_time': 0, 'max_wait_time': 0}
+    connection = pool.get_connection()
+    threading.Timer(0.1, pool.release, (connection,)).start()
+    assert pool.get_connection() is connection
+    status = pool.status()
+    assert status['in_use'] == 1 and status['idle'] == 0 and status['waits'] == 1
+    assert 0.05 < status['wait_time'] == status['max_wait_time'] < 1
+
+    pool.release(connection)
+    assert pool.status()['idle'] == 1
+
+
+def test_redis_lock_auto_renew(redis, redis_url):
+    lost = []
+    lock = Redis(redis_url).lock('name', 0.3, auto_renew=True, on_lost=lost.append)
+    assert lock.acquire(blocking=False)
+    time.sleep(0.5)
+    # lock is renewed past initial timeout
+    assert redis.exists('LOCK:name') and not lock.lost
+    lock.check()
+
+    redis.delete('LOCK:name')
+    time.sleep(0.2)
+    assert lock.lost and lost == [lock]
+    with pytest.raises(LockError):
+        lock.check()
+
+    assert lock.acquire(blocking=False) and not lock.lost
+    lock.release()
+    time.sleep(0.2)
+    assert not redis.exists('LOCK:name') and not lock.lost
@@ -0,0 +1,25 @@
+import pickle
+
+import pytest
+
+from flask_vgavro_utils.serializers import Serializer
+
+
+@pytest.mark.parametrize('codec', ['pickle', 'json'])
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_serializer(codec, compression):
+    serializer = Serializer(codec, compression, compress_min_size=100)
+    for value in ({'key': [1, 2, 'x']}, {'key': ['x' * 10] * 100}):
+        data = serializer.dumps(value)
+        assert serializer.loads(data) == value
+        # any serializer may read values written with other settings
+        assert Serializer().loads(data) == value
+
+
+def test_serializer_legacy_pickle():
+    value = {'key': [1, 2, 'x']}
+    assert Serializer('json').loads(pickle.dumps(value)) == value
+    assert pickle.loads(Serializer().dumps(value)) == value
+
+    with pytest.raises(ValueError):
+        Serializer().loads(b'?')
@@ -0,0 +1,120 @@
+from datetime import datetime
+
+import pytest
+import sqlalchemy as sa
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+from flask_vgavro_utils import userflow_sync
+from flask_vgavro_utils.exceptions import ImproperlyConfigured
+from flask_vgavro_utils.userflow_sync import (
+    SyncMixin, Synchronizer, sync_need_index, synchronize, sync_response)
+
+
+def _create_db():
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://',
+                      SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    db = SQLAlchemy(app)
+
+    class Item(SyncMixin, db.Model):
+        id = sa.Column(sa.Integer, primary_key=True)
+        name = sa.Column(sa.String)
+
+    sync_need_index(Item)
+    db.Item = Item
+    return app, db
+
+
+@pytest.fixture
+def db():
+    app, db = _create_db()
+    with app.app_context():
+        db.create_all()
+        yield db
+
+
+def _request(requested):
+    def request(payload):
+        ids = [id for id in payload['item']]
+        requested.append(ids)
+        return {'time': datetime.utcnow().isoformat(),
+                'item': {id: {'name': 'synced {}'.format(id)} for id in ids}}
+    return request
+
+
+def test_synchronize_pages_ids(db):
+    db.session.add_all(db.Item(id=id, name=str(id), sync_need=id % 5 != 0)
+                       for id in range(1, 31))
+    db.session.commit()
+
+    synchronizer = Synchronizer(db.Item, getters={'name': 'name'}, setters={'name': 'name'})
+    synchronizer.ids_batch_size = 10
+    requested = []
+    synchronize({'item': synchronizer}, _request(requested), batch_size=7)
+
+    ids = [int(id) for batch in requested for id in batch]
+    assert sorted(ids) == [id for id in range(1, 31) if id % 5 != 0]
+    assert [len(batch) for batch in requested] == [7, 7, 7, 3]
+    assert not db.Item.query.filter_by(sync_need=True).count()
+    assert db.session.get(db.Item, 1).name == 'synced 1'
+
+
+def test_get_ids_for_sync_uses_partial_index(db):
+    statements = []
+
+    @sa.event.listens_for(db.engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    assert list(Synchronizer(db.Item, getters={'name': 'name'}).get_ids_for_sync()) == []
+    statement, parameters = statements[-1]
+    plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement,
+                                                   parameters)
+    assert 'ix_item_sync_need' in ' '.join(row[-1] for row in plan)
+
+
+def test_synchronize_dedupes_ids(monkeypatch):
+    class FakeSynchronizer:
+        def get_ids_for_sync(self):
+            return [(1,), (2,), (1,), (3,), (3,)]
+
+        def finish(self):
+            pass
+
+    requested = []
+    monkeypatch.setattr(userflow_sync, 'sync_request',
+                        lambda synchronizers, request, data: requested.append(dict(data)))
+    synchronize({'item': FakeSynchronizer()}, None, commit=False, skip={'item': [2]})
+    assert requested == [{'item': [1, 3]}]
+
+
+def test_sync_response_bulk_saves_same_rows():
+    rows = {}
+    for bulk in (False, True):
+        app, db = _create_db()
+        with app.app_context():
+            db.create_all()
+            db.session.add_all(db.Item(id=id, name=str(id), sync_need=True) for id in (1, 2))
+            db.session.commit()
+            synchronizer = Synchronizer(db.Item, getters={'name': 'name'},
+                                        setters={'name': 'name'}, allow_create=True)
+            data = {'time': '2020-01-01T00:00:00',
+                    'item': {str(id): {'name': 'synced {}'.format(id)} for id in (2, 3)}}
+            rv = sync_response({'item': synchronizer}, data, bulk=bulk)
+            assert rv['item'] == data['item']
+            rows[bulk] = db.session.query(db.Item.__table__).order_by('id').all()
+    assert rows[True] == rows[False]
+    assert [row.name for row in rows[True]] == ['1', 'synced 2', 'synced 3']
+
+
+def test_sync_response_bulk_refuses_onupdate(db):
+    class Tracked(SyncMixin, db.Model):
+        id = sa.Column(sa.Integer, primary_key=True)
+        updated_at = sa.Column(sa.DateTime, onupdate=datetime.utcnow)
+
+    db.create_all()
+    synchronizer = Synchronizer(Tracked, getters={'updated_at': 'updated_at'})
+    with pytest.raises(ImproperlyConfigured):
+        sync_response({'tracked': synchronizer},
+                      {'time': '2020-01-01T00:00:00', 'tracked': {'1': {}}}, bulk=True)